@@ -14,6 +14,13 @@ def app(environ, start_response):
     return ret
 
 
+class Server(wsgiref.simple_server.WSGIServer):
+
+    # room for every probe's handshake at once, wsgiref's default of 5
+    # drops syns once many are in flight
+    request_queue_size = 1024
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('port_start', nargs=1, type=int)
@@ -31,7 +38,9 @@ def main():
     )
     threads = []
     for server in [
-            wsgiref.simple_server.make_server(args.host, port, app)
+            wsgiref.simple_server.make_server(
+                args.host, port, app, server_class=Server,
+            )
             for port in ports
             ]:
         logging.info('hosting %s:%s', *server.server_address)
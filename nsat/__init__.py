@@ -1,17 +1,28 @@
+import collections
+import functools
 import itertools
-import multiprocessing
+import socket
 import struct
 
 import constraint
-from scapy import all as scapy
 
-from .expression import var, and_, or_, not_, cnf, dnf, sat
-from .grammar import parse
-from . import spoof
+from .expression import (
+    Expression, var, and_, or_, not_, cnf, dnf, sat, simplify,
+)
+from .grammar import parse, ParseError
+from .cdcl import solve_cdcl
+from .counting import count
+from .executor import Executor
+from .matcher import checksums
+from .packing import Packing
+from .solver import components, expand, solver
+from .twosat import solve_2sat
+from . import dimacs, vector
 
 
 __all__ = [
     'parse',
+    'ParseError',
     'var',
     'and_',
     'or_',
@@ -19,139 +30,204 @@ __all__ = [
     'cnf',
     'dnf',
     'sat',
-    'spoof',
-    'solve_bool',
+    'simplify',
+    'expand',
+    'components',
+    'count',
+    'dimacs',
+    'Executor',
+    'solve_constraint',
+    'solve_2sat',
+    'solve_cdcl',
     'solve_checksum',
     'checksums',
     'checksums_http',
 ]
 
 
-def solve_constraint(expr):
+@solver
+def solve_constraint(cnf_expr):
 
     def _constraint(e):
-        vars = [var.name for var in sub_e.vars]
-        return lambda *vals: e.eval(dict(zip(vars, vals))), vars
-
+        evaluator = e.compile()
+        return (
+            lambda *vals: evaluator(vals),
+            [var.name for var in evaluator.vars],
+        )
+
+    if not isinstance(cnf_expr, Expression):
+        cnf_expr = cnf_expr.expr
     p = constraint.Problem()
-    expr = cnf(expr)
-    p.addVariables([var.name for var in expr.vars], [True, False])
-    for _, sub_es in expr.traverse(depth=1):
+    p.addVariables([var.name for var in cnf_expr.vars], [True, False])
+    for _, sub_es in cnf_expr.traverse(depth=1):
         for sub_e in sub_es:
             p.addConstraint(*_constraint(sub_e))
     for solution in p.getSolutions():
         yield solution
 
 
-def solve_checksum(expr, match=None, parallel=False):
-
-    sat_expr = sat(expr)
-    n = len(sat_expr.exprs[0])
-    match = match or checksums
-
-    def _checksums():
-        if n == 2:
-            g = itertools.product(*(
-                [(0b01, 0b10)] * len(sat_expr) +
-                [(0b00,)] * (8 - len(sat_expr))
-            ))
-        elif n == 3:
-            g = itertools.product(*(
-                [(0b01, 0b10, 0b11)] * len(sat_expr) +
-                [(0b00,)] * (8 - len(sat_expr))
-            ))
-        for parts in g:
-            checksum = 0
-            for i, part in enumerate(parts):
-                checksum |= part << (i * 2)
-            yield checksum
-
-    def _candidates():
-        for vals in itertools.product(*([(True, False)] * len(sat_expr.vars))):
-            yield dict(zip(sat_expr.vars, vals))
-
-    def _bin(expr, assigment):
-        val = assigment[expr.var]
-        if isinstance(expr, not_):
-            val = not val
-        return 0b01 if val else 0b00
-
-    def _assign(candidate):
-        d = [0] * n
-        for i, expr in enumerate(sat_expr):
-            for j in range(n):
-                d[j] |= _bin(expr[j], candidate) << (i * 2)
-        return d
-
-    def _debin(expr, assignment):
-        val = assignment == 0b01
-        return expr.var, (not val if isinstance(expr, not_) else val)
-
-    def _assigment(d):
-        assignment = set()
-        for i, expr in enumerate(sat_expr):
-            for j in range(n):
-                assignment.add(_debin(expr[j], (d[j] >> (i * 2)) & 0b01))
-        return dict(list(assignment))
-
-    cases = itertools.izip(
-        itertools.imap(_assign, _candidates()),
-        itertools.repeat(list(_checksums()))
-    )
+@solver
+def solve_checksum(cnf_expr, match=None, parallel=False):
+    packing = Packing(sat(cnf_expr))
+    # local checksums are matched on packing's running sums
+    match = None if match in (None, checksums) else match
+    executor = None
     if parallel:
-        pool = multiprocessing.Pool()
-        matches = pool.imap(match, cases)
+        executor = parallel if isinstance(parallel, Executor) else Executor()
+        candidates = executor.matches(packing, match)
+    elif match is None and vector.numpy is not None:
+        candidates = vector.matches(packing, packing.checksums())
     else:
-        matches = itertools.imap(match, cases)
-    for data, soln in matches:
-        if soln:
-            yield dict(
-                (var.name, val)
-                for var, val in _assigment(data).iteritems()
-            )
-
-
-def checksums((data, checksums)):
-    return data, any(sum(data) == checksum for checksum in checksums)
+        candidates = packing.matches(match, packing.checksums())
+    try:
+        for candidate in candidates:
+            yield packing.assignment(candidate)
+    finally:
+        if executor is not None and executor is not parallel:
+            executor.terminate()
 
 
 class _CheckSumHTTP(object):
 
-    def __init__(self, host, path='/', retry=0, verbose=0, timeout=1.0):
+    def __init__(self, host, path='/', retry=0, verbose=0, timeout=1.0,
+                 window=64, limit=256, min_rto=0.01, max_rto=None):
         self.host = host
         self.path = path
         self.retry = retry
         self.verbose = verbose
-        self.timeout = verbose
-
-    def __call__(self, (data, checksums)):
-        data_fmt = '!' + 'H' * len(data)
-        for checksum in checksums:
-            cxn = spoof.Connection(*self.host, verbose=self.verbose)
-            with cxn.open():
-                pkt = cxn.sendp(spoof.http_get_payload(
-                    self.path,
-                    data=struct.pack(
-                        data_fmt, *([checksum] + [0] * (len(data) - 1))
-                    ),
-                ))
-                c = type(pkt)(str(pkt))[scapy.TCP].chksum
+        self.timeout = timeout
+        self.window = window
+        self.limit = limit
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.rto = None
+
+    def __call__(self, item):
+        return next(self.imap([item]))
+
+    def imap(self, items):
+        # (data, matched) for each (data, checksums) in order. probes for up
+        # to window candidates are queued as jobs for a pool of connections
+        # on one engine, each connection answering many of them.
+        # raw sockets are only needed here
+        from . import spoof
+
+        # probes wait on the host's rtt rather than timeout, which is only
+        # where that starts (and by default its bound)
+        if self.rto is None:
+            self.rto = spoof.RTO(self.timeout, self.min_rto, self.max_rto)
+        engine = spoof.Engine(*self.host, limit=self.limit)
+        jobs = collections.deque()
+        # job -> handshakes timed out
+        failed = collections.defaultdict(int)
+
+        def _take():
+            # the next job still wanted
+            while jobs:
+                job = jobs.popleft()
+                if job[3]():
+                    return job
+            return None
+
+        def _put(job, timed_out=False):
+            # for another connection, unless the host doesn't answer one
+            # retry times over
+            if not job[3]():
+                return
+            if timed_out:
+                failed[job] += 1
+                if failed[job] > self.retry:
+                    raise socket.timeout('timed out')
+            jobs.appendleft(job)
+            engine.spawn(_connect)
+
+        def _connect(segment):
+            return spoof.probes(
+                segment, _take, _put, self.rto, retry=self.retry,
+            )
+
+        items = iter(items)
+        pending = collections.deque()
+        try:
+            for item in itertools.islice(items, self.window):
+                pending.append(self._submit(engine, jobs, _connect, item))
+            while pending:
+                state = pending[0]
+                engine.run(lambda: state[1] is not None)
+                pending.popleft()
+                for item in itertools.islice(items, 1):
+                    pending.append(self._submit(engine, jobs, _connect, item))
+                yield tuple(state)
+        finally:
+            # e.g. closed early, connections still open take nothing more
+            # and just close
+            jobs.clear()
+            for state in pending:
+                if state[1] is None:
+                    state[1] = False
+            engine.close()
+
+    def _submit(self, engine, jobs, connect, (data, checksums)):
+        # a probe's tcp checksum only covers one 16-bit sum, so a group
+        # (i.e. n words) is probed at a time, a job per checksum. state is
+        # [data, matched], matched is None until every group has an acked
+        # probe or a group has none. each job may need a connection of its
+        # own, one w/ nothing left to take by then stops right away.
+        from . import spoof
+
+        n = len(data) // len(checksums) if checksums else 0
+        state = [data, None]
+        if not checksums or not all(checksums):
+            # nothing to probe
+            state[1] = all(checksums)
+        found = [False] * len(checksums)
+        left = [len(group) for group in checksums]
+
+        def _done(g, acked):
+            left[g] -= 1
+            found[g] = found[g] or acked
+            if state[1] is None and not found[g] and not left[g]:
+                state[1] = False
+            elif state[1] is None and all(found):
+                state[1] = True
+
+        def _wanted(g):
+            return state[1] is None and not found[g]
+
+        def _checksum(zeros, checksum, segment):
+            return spoof.update(
+                segment.set(payload=zeros).checksum, 0, checksum,
+            )
 
-                pkt = cxn.sendp(spoof.http_get_payload(
-                    self.path,
-                    data=struct.pack(data_fmt, *(data)),
+        for g, group in enumerate(checksums):
+            words = data[g * n:(g + 1) * n]
+            data_fmt = '!' + 'H' * len(words)
+            payload = spoof.http_get_payload(
+                self.path, data=struct.pack(data_fmt, *words),
+            )
+            zeros = spoof.http_get_payload(
+                self.path, data=struct.pack(data_fmt, *([0] * len(words))),
+            )
+            # the probe's checksum is that of the zeros w/ the first word
+            # set to checksum, patched in. at an odd offset a word sums
+            # byte swapped.
+            odd = (len(payload) - 2 - 2 * len(words)) % 2
+            for checksum in sorted(group):
+                if odd:
+                    checksum = (checksum >> 8) | (checksum & 0xff) << 8
+                jobs.append((
+                    payload,
+                    functools.partial(_checksum, zeros, checksum),
+                    functools.partial(_done, g),
+                    functools.partial(_wanted, g),
                 ))
-                pkt[scapy.TCP].chksum = c
-                count = 0
-                while self.retry - count >= 0:
-                    if cxn.send(pkt, timeout=self.timeout):
-                        spoof.http_resp(cxn)
-                        return data, True
-                    count += 1
-        return data, False
+                engine.spawn(connect)
+        return state
 
 
-def checksums_http(host, path='/', retry=0, verbose=1, timeout=1.0):
+def checksums_http(host, path='/', retry=0, verbose=1, timeout=1.0,
+                   window=64, limit=256, min_rto=0.01, max_rto=None):
     return _CheckSumHTTP(
         host, path=path, retry=retry, verbose=verbose, timeout=timeout,
+        window=window, limit=limit, min_rto=min_rto, max_rto=max_rto,
     )
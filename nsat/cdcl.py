@@ -0,0 +1,258 @@
+import heapq
+
+from .expression import clauses
+from .solver import implicant, solver
+
+
+def luby(i):
+    # 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, ...
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    while (1 << k) - 1 != i:
+        i -= (1 << (k - 1)) - 1
+        k = 1
+        while (1 << k) - 1 < i:
+            k += 1
+    return 1 << (k - 1)
+
+
+class Solver(object):
+
+    # literal 2 * i is var i, 2 * i + 1 is !var i. values are per literal,
+    # 1 true, 0 false and -1 unassigned.
+
+    decay = 0.95
+
+    restart = 100
+
+    def __init__(self, n, clauses=()):
+        self.n = n
+        self.value = [-1] * (2 * n)
+        self.level = [0] * n
+        self.reason = [None] * n
+        self.phase = [1] * n
+        self.activity = [0.0] * n
+        self.inc = 1.0
+        self.heap = [(0.0, v) for v in xrange(n)]
+        self.trail, self.trail_lim, self.qhead = [], [], 0
+        self.clauses, self.learnts = [], []
+        self.watches = [[] for _ in xrange(2 * n)]
+        self.ok = True
+        for clause in clauses:
+            if not self.add_clause(clause):
+                break
+        self.max_learnts = len(self.clauses) // 3 + 100
+
+    def add_clause(self, lits):
+        # only at decision level 0
+        if not self.ok:
+            return False
+        clause, lits = [], set(lits)
+        for lit in lits:
+            if lit ^ 1 in lits or self.value[lit] == 1:
+                return True
+            if self.value[lit] == -1:
+                clause.append(lit)
+        if not clause:
+            self.ok = False
+        elif len(clause) == 1:
+            self._enqueue(clause[0], None)
+            self.ok = self._propagate() is None
+        else:
+            self._attach(clause)
+        return self.ok
+
+    def _attach(self, clause):
+        self.clauses.append(clause)
+        ci = len(self.clauses) - 1
+        self.watches[clause[0]].append(ci)
+        self.watches[clause[1]].append(ci)
+        return ci
+
+    def _enqueue(self, lit, reason):
+        self.value[lit], self.value[lit ^ 1] = 1, 0
+        self.level[lit >> 1] = len(self.trail_lim)
+        self.reason[lit >> 1] = reason
+        self.trail.append(lit)
+
+    def _propagate(self):
+        value, clauses, watches = self.value, self.clauses, self.watches
+        while self.qhead < len(self.trail):
+            false_lit = self.trail[self.qhead] ^ 1
+            self.qhead += 1
+            ws = watches[false_lit]
+            i = j = 0
+            while i < len(ws):
+                ci = ws[i]
+                i += 1
+                c = clauses[ci]
+                if c is None:
+                    continue
+                if c[0] == false_lit:
+                    c[0], c[1] = c[1], false_lit
+                if value[c[0]] == 1:
+                    ws[j] = ci
+                    j += 1
+                    continue
+                for k in xrange(2, len(c)):
+                    if value[c[k]] != 0:
+                        c[1], c[k] = c[k], false_lit
+                        watches[c[1]].append(ci)
+                        break
+                else:
+                    ws[j] = ci
+                    j += 1
+                    if value[c[0]] == 0:
+                        ws[j:] = ws[i:]
+                        return ci
+                    self._enqueue(c[0], ci)
+            del ws[j:]
+        return None
+
+    def _analyze(self, confl):
+        # first uip, the asserting literal ends up first
+        seen, level = set(), len(self.trail_lim)
+        learnt, count, p, i = [None], 0, None, len(self.trail) - 1
+        c = self.clauses[confl]
+        while True:
+            for q in (c if p is None else c[1:]):
+                v = q >> 1
+                if v not in seen and self.level[v] > 0:
+                    seen.add(v)
+                    self._bump(v)
+                    if self.level[v] == level:
+                        count += 1
+                    else:
+                        learnt.append(q)
+            while self.trail[i] >> 1 not in seen:
+                i -= 1
+            p = self.trail[i]
+            i -= 1
+            count -= 1
+            if count == 0:
+                break
+            c = self.clauses[self.reason[p >> 1]]
+        learnt[0] = p ^ 1
+        # drop literals implied by the rest of the clause
+        learnt[1:] = [
+            q for q in learnt[1:]
+            if self.reason[q >> 1] is None or not all(
+                r >> 1 in seen or self.level[r >> 1] == 0
+                for r in self.clauses[self.reason[q >> 1]][1:]
+            )
+        ]
+        if len(learnt) == 1:
+            return learnt, 0
+        k = max(
+            xrange(1, len(learnt)), key=lambda k: self.level[learnt[k] >> 1]
+        )
+        learnt[1], learnt[k] = learnt[k], learnt[1]
+        return learnt, self.level[learnt[1] >> 1]
+
+    def _reduce(self):
+        # forget the longer half of the learnt clauses not in use as reasons
+        self.learnts.sort(key=lambda ci: len(self.clauses[ci]))
+        keep = self.learnts[:len(self.learnts) // 2]
+        for ci in self.learnts[len(self.learnts) // 2:]:
+            c = self.clauses[ci]
+            if self.reason[c[0] >> 1] == ci and self.value[c[0]] == 1:
+                keep.append(ci)
+            else:
+                self.clauses[ci] = None
+        self.learnts = keep
+
+    def _bump(self, v):
+        self.activity[v] += self.inc
+        if self.activity[v] > 1e100:
+            self.activity = [a * 1e-100 for a in self.activity]
+            self.inc *= 1e-100
+            self.heap = [(-self.activity[u], u) for _, u in self.heap]
+            heapq.heapify(self.heap)
+        heapq.heappush(self.heap, (-self.activity[v], v))
+
+    def _backtrack(self, level):
+        if len(self.trail_lim) <= level:
+            return
+        for lit in self.trail[self.trail_lim[level]:]:
+            v = lit >> 1
+            self.value[lit] = self.value[lit ^ 1] = -1
+            self.reason[v] = None
+            self.phase[v] = lit & 1
+            heapq.heappush(self.heap, (-self.activity[v], v))
+        del self.trail[self.trail_lim[level]:]
+        del self.trail_lim[level:]
+        self.qhead = len(self.trail)
+
+    def _decide(self):
+        while self.heap:
+            a, v = heapq.heappop(self.heap)
+            if self.value[2 * v] == -1 and -a == self.activity[v]:
+                return 2 * v + self.phase[v]
+        return None
+
+    def _search(self):
+        conflicts, restarts = 0, 1
+        while True:
+            confl = self._propagate()
+            if confl is not None:
+                if not self.trail_lim:
+                    self.ok = False
+                    return False
+                learnt, level = self._analyze(confl)
+                self._backtrack(level)
+                if len(learnt) == 1:
+                    self._enqueue(learnt[0], None)
+                else:
+                    ci = self._attach(learnt)
+                    self.learnts.append(ci)
+                    self._enqueue(learnt[0], ci)
+                self.inc /= self.decay
+                conflicts += 1
+                if conflicts >= self.restart * luby(restarts):
+                    conflicts, restarts = 0, restarts + 1
+                    self._backtrack(0)
+                    self.max_learnts += self.max_learnts // 10
+                continue
+            if len(self.learnts) - len(self.trail) >= self.max_learnts:
+                self._reduce()
+            lit = self._decide()
+            if lit is None:
+                return True
+            self.trail_lim.append(len(self.trail))
+            self._enqueue(lit, None)
+
+    def models(self, cubes=False):
+        # each model is blocked by negating its decisions, everything else
+        # follows from them so no model is lost or repeated. w/ cubes it's
+        # shrunk to literals that satisfy the clauses (blocks included, so
+        # cubes are disjoint) and that cube is blocked, None is free.
+        while self.ok and self._search():
+            if not cubes:
+                yield [self.value[2 * v] == 1 for v in xrange(self.n)]
+                block = [self.trail[i] ^ 1 for i in self.trail_lim]
+            else:
+                learnts = set(self.learnts)
+                cube = implicant(
+                    (c for ci, c in enumerate(self.clauses)
+                     if c is not None and ci not in learnts),
+                    self.value,
+                    self.trail[:self.trail_lim[0]]
+                    if self.trail_lim else self.trail,
+                )
+                model = [None] * self.n
+                for lit in cube:
+                    model[lit >> 1] = not lit & 1
+                yield model
+                block = [lit ^ 1 for lit in cube]
+            self._backtrack(0)
+            self.add_clause(block)
+
+
+@solver(cubes=True)
+def solve_cdcl(cnf_expr, cubes=False):
+    vars, lits = clauses(cnf_expr)
+    for vals in Solver(len(vars), lits).models(cubes):
+        yield dict(
+            (var.name, val) for var, val in zip(vars, vals) if val is not None
+        )
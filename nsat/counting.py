@@ -0,0 +1,100 @@
+import collections
+
+from .expression import Expression, cnf, clauses
+
+
+class Counter(object):
+
+    # dpll w/ unit propagation over clauses of literals (2 * i is var i,
+    # 2 * i + 1 !var i). a formula splitting into var-disjoint components
+    # counts as their product and each component's count is cached, keyed
+    # by its clauses.
+
+    def __init__(self):
+        self.cache = {}
+
+    def count(self, cs):
+        # models over cs's vars
+        if not cs:
+            return 1
+        if cs in self.cache:
+            return self.cache[cs]
+        components = self.components(cs)
+        if len(components) > 1:
+            total = 1
+            for component in components:
+                total *= self.count(component)
+                if not total:
+                    break
+        else:
+            occurs = collections.Counter(l >> 1 for c in cs for l in c)
+            v = occurs.most_common(1)[0][0]
+            total = 0
+            for lit in (2 * v, 2 * v + 1):
+                reduced, fixed = self.assign(cs, lit)
+                if reduced is None:
+                    continue
+                free = len(occurs) - fixed - len(_vars(reduced))
+                total += self.count(reduced) << free
+        self.cache[cs] = total
+        return total
+
+    def assign(self, cs, lit):
+        # cs w/ lit and whatever it forces true, None on a conflict. also
+        # the number of vars fixed.
+        trues, units = set(), [lit]
+        while units:
+            trues.update(units)
+            falses = frozenset(l ^ 1 for l in units)
+            if falses & trues:
+                return None, 0
+            reduced = []
+            for c in cs:
+                if c.isdisjoint(trues):
+                    c = c - falses
+                    if not c:
+                        return None, 0
+                    reduced.append(c)
+            cs = frozenset(reduced)
+            units = set(next(iter(c)) for c in cs if len(c) == 1) - trues
+        return cs, len(trues)
+
+    def components(self, cs):
+        occurs = collections.defaultdict(list)
+        for c in cs:
+            for l in c:
+                occurs[l >> 1].append(c)
+        seen, components = set(), []
+        for c in cs:
+            if c in seen:
+                continue
+            seen.add(c)
+            component, stack = [c], [c]
+            while stack:
+                for l in stack.pop():
+                    for d in occurs[l >> 1]:
+                        if d not in seen:
+                            seen.add(d)
+                            component.append(d)
+                            stack.append(d)
+            components.append(frozenset(component))
+        return components
+
+
+def _vars(cs):
+    return set(l >> 1 for c in cs for l in c)
+
+
+def count(expr, mode='distribute'):
+    # exact, w/o enumerating. expr is an expression or a clause store (see
+    # dimacs). tseitin vars are fixed by the others so counts don't change.
+    cnf_expr = cnf(expr, mode) if isinstance(expr, Expression) else expr
+    vars, lits = clauses(cnf_expr)
+    cs = frozenset(
+        frozenset(c) for c in lits if not any(l ^ 1 in c for l in c)
+    )
+    if frozenset() in cs:
+        return 0
+    free = len(vars) - len(_vars(cs))
+    free += len(set(expr.vars) - set(vars))
+    return Counter().count(cs) << free
@@ -0,0 +1,116 @@
+import array
+
+from .expression import Expression, var, not_, and_, or_, cnf, clauses
+
+
+class Clauses(object):
+
+    # clause i is lits[offsets[i]:offsets[i + 1]], literal 2 * i is var i and
+    # 2 * i + 1 is !var i. literals are machine ints in flat arrays so large
+    # instances don't become trees of expressions.
+
+    def __init__(self, names=(), clauses=()):
+        self.names = list(names)
+        self.lits = array.array('i')
+        self.offsets = array.array('i', [0])
+        self._vars = None
+        for clause in clauses:
+            self.append(clause)
+
+    @classmethod
+    def from_expr(cls, expr, mode='distribute'):
+        vars, lits = clauses(cnf(expr, mode))
+        return cls([v.name for v in vars], lits)
+
+    def append(self, clause):
+        self.lits.extend(clause)
+        self.offsets.append(len(self.lits))
+
+    @property
+    def vars(self):
+        if self._vars is None or len(self._vars) != len(self.names):
+            self._vars = tuple(var(name) for name in self.names)
+        return self._vars
+
+    @property
+    def expr(self):
+        vars = self.vars
+
+        def _lit(l):
+            return not_(vars[l >> 1]) if l & 1 else vars[l >> 1]
+
+        return and_(or_(map(_lit, clause)) for clause in self)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.lits[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        lits, offsets = self.lits, self.offsets
+        for i in xrange(len(offsets) - 1):
+            yield lits[offsets[i]:offsets[i + 1]]
+
+
+def load(fp, names='x{0}'):
+    # fp is any iterable of lines, clauses may span lines and a '%' line
+    # (as in satlib) ends the data
+    store, n = None, 0
+    for line in fp:
+        line = line.strip()
+        if not line or line[0] == 'c':
+            continue
+        if line[0] == '%':
+            break
+        if line[0] == 'p':
+            fields = line.split()
+            if len(fields) != 4 or fields[1] != 'cnf' or store is not None:
+                raise ValueError('{0} invalid'.format(line))
+            n = int(fields[2])
+            store = Clauses(names.format(i) for i in xrange(1, n + 1))
+            lits, offsets = store.lits, store.offsets
+            continue
+        if store is None:
+            raise ValueError('{0} before problem line'.format(line))
+        for lit in map(int, line.split()):
+            if lit == 0:
+                offsets.append(len(lits))
+            elif -n <= lit <= n:
+                lits.append(2 * (abs(lit) - 1) + (lit < 0))
+            else:
+                raise ValueError('{0} invalid'.format(lit))
+    if store is None:
+        raise ValueError('missing problem line')
+    if offsets[-1] != len(lits):
+        offsets.append(len(lits))
+    return store
+
+
+def dump(store, fp):
+    if isinstance(store, Expression):
+        store = Clauses.from_expr(store)
+    for i, name in enumerate(store.names):
+        fp.write('c {0} {1}\n'.format(i + 1, name))
+    fp.write('p cnf {0} {1}\n'.format(len(store.names), len(store)))
+    for clause in store:
+        fp.write(' '.join(
+            str(-((l >> 1) + 1) if l & 1 else (l >> 1) + 1) for l in clause
+        ))
+        fp.write(' 0\n' if clause else '0\n')
+    return store
+
+
+def dump_models(solutions, store, fp):
+    count = 0
+    for solution in solutions:
+        if not count:
+            fp.write('s SATISFIABLE\n')
+        fp.write('v {0} 0\n'.format(' '.join(
+            str(i + 1 if solution[name] else -(i + 1))
+            for i, name in enumerate(store.names)
+        )))
+        count += 1
+    if not count:
+        fp.write('s UNSATISFIABLE\n')
+    return count
@@ -0,0 +1,60 @@
+import collections
+import itertools
+import multiprocessing
+
+
+# worker side, checksums for the job being expanded
+_job = [None, None]
+
+
+def _matches((job, lo, hi)):
+    key, packing, match = job
+    if _job[0] != key:
+        _job[:] = [key, packing.checksums()]
+    return list(packing.matches(match, _job[1], lo, hi))
+
+
+class Executor(object):
+
+    def __init__(self, processes=None, chunksize=1 << 12, window=None):
+        processes = processes or multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(processes)
+        self.chunksize = chunksize
+        self.window = window or 4 * processes
+        self.jobs = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def matches(self, packing, match):
+        job = (next(self.jobs), packing, match)
+        tasks = (
+            (job, lo, hi) for lo, hi in packing.ranges(self.chunksize)
+        )
+        # only a window of tasks is in flight, so once this is closed (e.g.
+        # enough solutions) the pool stops after those instead of working
+        # through the rest of the job
+        pending = collections.deque(
+            self.pool.apply_async(_matches, (task,))
+            for task in itertools.islice(tasks, self.window)
+        )
+        while pending:
+            candidates = pending.popleft().get()
+            for task in itertools.islice(tasks, 1):
+                pending.append(self.pool.apply_async(_matches, (task,)))
+            for candidate in candidates:
+                yield candidate
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
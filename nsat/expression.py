@@ -4,10 +4,36 @@ import collections
 import itertools
 import random
 import types
+import weakref
 
 
 class Expression(object):
 
+    # nodes are hash-consed, so structural equality is identity
+    __slots__ = ('_hash', '_vars', '__weakref__')
+
+    _nodes = weakref.WeakValueDictionary()
+
+    @classmethod
+    def _intern(cls, *key):
+        key = (cls,) + key
+        self = Expression._nodes.get(key)
+        if self is not None:
+            return self, False
+        self = super(Expression, cls).__new__(cls)
+        self._hash, self._vars = hash(key), None
+        Expression._nodes[key] = self
+        return self, True
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
     def cnf(self):
         raise NotImplementedError
 
@@ -27,11 +53,27 @@ class Expression(object):
         raise NotImplementedError
 
     def traverse(self, depth=None):
+        # pre-order w/ an explicit stack, emptying a node's sub_es skips them
+        stack = [(self, depth)]
+        while stack:
+            e, depth = stack.pop()
+            sub_es = e.sub_exprs()
+            yield e, sub_es
+            if depth is not None:
+                depth -= 1
+                if not depth:
+                    continue
+            stack.extend((sub_e, depth) for sub_e in reversed(sub_es))
+
+    def sub_exprs(self):
         raise NotImplementedError
 
     def eval(self, assigments):
         raise NotImplementedError
 
+    def compile(self, vars=None):
+        return Evaluator(self, vars)
+
     @property
     def var(self):
         vars = self.vars
@@ -43,21 +85,42 @@ class Expression(object):
 
     @property
     def vars(self):
-        return collections.OrderedDict(
-            (e, None) for e, _ in self.traverse() if isinstance(e, Variable)
-        ).keys()
+        # in order of first occurrence, shared and already indexed nodes are
+        # only walked once
+        if self._vars is None:
+            vars, found, seen, stack = [], set(), set(), [self]
+            while stack:
+                e = stack.pop()
+                if e in seen:
+                    continue
+                seen.add(e)
+                if e._vars is not None or isinstance(e, Variable):
+                    vars.extend(v for v in e.vars if v not in found)
+                    found.update(e.vars)
+                else:
+                    stack.extend(reversed(e.sub_exprs()))
+            self._vars = tuple(vars)
+        return self._vars
 
 
 class Variable(Expression):
 
-    def __init__(self, name=None):
-        super(Variable, self).__init__()
-        name = name or self.generate_name()
-        self.name = (
+    __slots__ = ('name',)
+
+    def __new__(cls, name=None):
+        name = name or cls.generate_name()
+        name = (
             name.decode('utf-8')
             if isinstance(name, basestring)
             else name
         )
+        self, new = cls._intern(name)
+        if new:
+            self.name = name
+        return self
+
+    def __reduce__(self):
+        return type(self), (self.name,)
 
     @classmethod
     def generate_name(cls):
@@ -66,19 +129,17 @@ class Variable(Expression):
     def __cmp__(self, other):
         return self.name.__cmp__(other.name)
 
-    def __eq__(self, other):
-        return self.name.__eq__(other.name)
-
-    def __hash__(self):
-        return hash(self.name)
-
     # Expression
 
+    @property
+    def vars(self):
+        return (self,)
+
     def invert(self):
         return not_(self)
 
-    def traverse(self, depth=None):
-        yield self, []
+    def sub_exprs(self):
+        return []
 
     def eval(self, assigments):
         return assigments[self.name]
@@ -95,17 +156,27 @@ class Variable(Expression):
 
 class VectorOp(Expression):
 
+    __slots__ = ('exprs', '_symbol')
+
     symbol = None
 
-    def __init__(self, *exprs, **kwargs):
-        super(VectorOp, self).__init__()
+    def __new__(cls, *exprs, **kwargs):
         if len(exprs) == 1:
             if isinstance(exprs[0], types.GeneratorType):
                 exprs = exprs[0]
             elif isinstance(exprs[0], (list, tuple)):
                 exprs = exprs[0]
-        self.exprs = list(exprs)
-        self.symbol = kwargs.pop('symbol', self.symbol)
+        exprs = tuple(exprs)
+        symbol = kwargs.pop('symbol', None)
+        if symbol == cls.symbol:
+            symbol = None
+        self, new = cls._intern(exprs, symbol)
+        if new:
+            self.exprs, self._symbol = exprs, symbol
+        return self
+
+    def __reduce__(self):
+        return _vector_op, (type(self), self.exprs, self._symbol)
 
     def __len__(self):
         return len(self.exprs)
@@ -124,20 +195,12 @@ class VectorOp(Expression):
                     e = e.collapse()
                 es.append(e)
                 del sub_es[:]
-        return type(self)(es, symbol=self.symbol)
+        return type(self)(es, symbol=self._symbol)
 
     # Expression
 
-    def traverse(self, depth=None):
-        sub_es = self.exprs[:]
-        yield self, sub_es
-        if depth is not None:
-            depth -= 1
-            if not depth:
-                return
-        for sub_e in sub_es:
-            for n_e, n_sub_es in sub_e.traverse(depth):
-                yield n_e, n_sub_es
+    def sub_exprs(self):
+        return list(self.exprs)
 
     def __unicode__(self):
 
@@ -148,7 +211,7 @@ class VectorOp(Expression):
                  len(e) > 1)
             )
 
-        return ' {op} '.format(op=self.symbol).join(
+        return ' {op} '.format(op=self._symbol or self.symbol).join(
             '({0})'.format(e) if _parenthesize(e) else unicode(e)
             for e in self.exprs
         )
@@ -156,6 +219,8 @@ class VectorOp(Expression):
 
 class And(VectorOp):
 
+    __slots__ = ()
+
     # Expression
 
     def cnf(self):
@@ -164,7 +229,7 @@ class And(VectorOp):
     def dnf(self):
 
         def _dnf(expr):
-            dnf_e, dnf_es = self.l.dnf(), []
+            dnf_e, dnf_es = expr.dnf(), []
             for e, sub_es in dnf_e.traverse():
                 if not isinstance(e, Or):
                     dnf_es.append(e)
@@ -191,6 +256,8 @@ class And(VectorOp):
 
 class Or(VectorOp):
 
+    __slots__ = ()
+
     # Expression
 
     def cnf(self):
@@ -226,34 +293,40 @@ class Or(VectorOp):
 
 class UnaryOp(Expression):
 
+    __slots__ = ('expr', '_symbol')
+
     symbol = None
 
-    def __init__(self, expr, symbol=None):
-        super(UnaryOp, self).__init__()
-        self.expr = expr
-        self.symbol = symbol or self.symbol
+    def __new__(cls, expr, symbol=None):
+        if symbol == cls.symbol:
+            symbol = None
+        self, new = cls._intern(expr, symbol)
+        if new:
+            self.expr, self._symbol = expr, symbol
+        return self
 
-    def traverse(self, depth=None):
-        sub_es = [self.expr]
-        yield self, sub_es
-        if depth is not None:
-            depth -= 1
-            if depth:
-                return
-        for sub_e in sub_es:
-            for n_e, n_sub_es in sub_e.traverse(depth):
-                yield n_e, n_sub_es
+    def __reduce__(self):
+        return type(self), (self.expr, self._symbol)
+
+    def sub_exprs(self):
+        return [self.expr]
 
 
 class Not(UnaryOp):
 
+    __slots__ = ()
+
     # Expression
 
     def cnf(self):
-        return self if isinstance(self.expr, Variable) else ~self.expr
+        if isinstance(self.expr, Variable):
+            return self
+        return (~self.expr).cnf()
 
     def dnf(self):
-        return self if isinstance(self.expr, Variable) else ~self.expr
+        if isinstance(self.expr, Variable):
+            return self
+        return (~self.expr).dnf()
 
     def __unicode__(self):
 
@@ -261,14 +334,14 @@ class Not(UnaryOp):
             return isinstance(e, VectorOp) and len(e) > 1
 
         return '{0}{1}'.format(
-            self.symbol,
+            self._symbol or self.symbol,
             '({0})'.format(self.expr)
             if _parenthesize(self.expr)
             else self.expr
         )
 
     def invert(self):
-        return self.e
+        return self.expr
 
     def eval(self, assigments):
         return not self.expr.eval(assigments)
@@ -278,6 +351,10 @@ class Not(UnaryOp):
     symbol = '!'
 
 
+def _vector_op(cls, exprs, symbol):
+    return cls(exprs, symbol=symbol)
+
+
 and_ = And
 
 or_ = Or
@@ -289,15 +366,399 @@ def var(name=None):
     return Variable(name)
 
 
-def cnf(expr):
-    return expr.cnf()
+class Evaluator(object):
+
+    # flattens an expression into straight-line bitwise ops over ints, one
+    # per var, whose bits are lanes (i.e. assignments evaluated at once)
+
+    def __init__(self, expr, vars=None):
+        self.expr = expr
+        self.vars = tuple(expr.vars if vars is None else vars)
+        index = dict((v, i) for i, v in enumerate(self.vars))
+        lines, names = [], {}
+        stack = [expr]
+        while stack:
+            e = stack[-1]
+            if e in names:
+                stack.pop()
+                continue
+            if isinstance(e, Variable):
+                if e not in index:
+                    raise ValueError('{0} not in vars'.format(e))
+                line = 'v[{0}]'.format(index[e])
+            elif isinstance(e, Not):
+                if e.expr not in names:
+                    stack.append(e.expr)
+                    continue
+                line = 'mask ^ {0}'.format(names[e.expr])
+            else:
+                pending = [sub_e for sub_e in e if sub_e not in names]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                line = (' & ' if isinstance(e, And) else ' | ').join(
+                    names[sub_e] for sub_e in e
+                )
+            names[e] = 't{0}'.format(len(lines))
+            lines.append('    {0} = {1}'.format(names[e], line))
+            stack.pop()
+        source = 'def _eval(v, mask):\n{0}\n    return {1}\n'.format(
+            '\n'.join(lines), names[expr],
+        )
+        code, namespace = compile(source, '<evaluator>', 'exec'), {}
+        exec code in namespace
+        self._eval = namespace['_eval']
+
+    def __call__(self, bits, mask=1):
+        return self._eval(bits, mask)
+
+    def eval(self, assigments):
+        return bool(self._eval([
+            1 if assigments[v.name] else 0 for v in self.vars
+        ], 1))
+
+    def models(self, width=1024):
+        n = len(self.vars)
+        k = min(n, width.bit_length() - 1)
+        width = 1 << k
+        mask = (1 << width) - 1
+        # lane j of var i < k is bit i of j, higher vars are fixed per block
+        lanes = [
+            (((1 << (1 << i)) - 1) << (1 << i)) *
+            (mask // ((1 << (2 << i)) - 1))
+            for i in xrange(k)
+        ]
+        for block in itertools.count():
+            base = block << k
+            if base >> n:
+                break
+            bits = lanes + [
+                mask if (base >> i) & 1 else 0 for i in xrange(k, n)
+            ]
+            r = self._eval(bits, mask)
+            while r:
+                low = r & -r
+                r ^= low
+                c = base | (low.bit_length() - 1)
+                yield dict(
+                    (v.name, bool((c >> i) & 1))
+                    for i, v in enumerate(self.vars)
+                )
+
+
+def cnf(expr, mode='distribute'):
+    if mode == 'distribute':
+        # a left-leaning chain of binary ops is one n-ary op to distribute
+        if isinstance(expr, VectorOp):
+            expr = expr.collapse()
+        return expr.cnf()
+    if mode == 'tseitin':
+        return tseitin(expr)
+    raise ValueError('mode={0} invalid'.format(mode))
+
+
+def tseitin(expr):
+    # equisatisfiable cnf w/ an auxiliary var per gate, each defined by
+    # equivalence so models project 1:1 back onto the original vars
+    clauses, lits = [], {}
+
+    def _neg(lit):
+        return lit.expr if isinstance(lit, Not) else not_(lit)
+
+    def _gate(op, a, b):
+        x = var()
+        if op is And:
+            clauses.extend([
+                or_(_neg(x), a), or_(_neg(x), b), or_(x, _neg(a), _neg(b)),
+            ])
+        else:
+            clauses.extend([
+                or_(_neg(x), a, b), or_(x, _neg(a)), or_(x, _neg(b)),
+            ])
+        return x
+
+    def _lit(e):
+        stack = [e]
+        while stack:
+            e = stack[-1]
+            if e in lits:
+                stack.pop()
+                continue
+            if isinstance(e, Variable):
+                lits[e] = e
+            elif isinstance(e, Not):
+                if e.expr not in lits:
+                    stack.append(e.expr)
+                    continue
+                lits[e] = _neg(lits[e.expr])
+            else:
+                pending = [sub_e for sub_e in e if sub_e not in lits]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                lit = lits[e[-1]]
+                for sub_e in reversed(e[:-1]):
+                    lit = _gate(type(e), lits[sub_e], lit)
+                lits[e] = lit
+            stack.pop()
+        return lits[e]
+
+    def _flatten(e, op):
+        es, stack = [], [e]
+        while stack:
+            e = stack.pop()
+            if isinstance(e, op):
+                stack.extend(reversed(e.exprs))
+            else:
+                es.append(e)
+        return es
+
+    for e in _flatten(expr, And):
+        if isinstance(e, Or):
+            clause = [_lit(sub_e) for sub_e in _flatten(e, Or)]
+            while len(clause) > 3:
+                b, a = clause.pop(), clause.pop()
+                clause.append(_gate(Or, a, b))
+            clauses.append(or_(clause))
+        else:
+            clauses.append(_lit(e))
+    return and_(clauses)
+
+
+def project(solutions, expr):
+    names = [var.name for var in expr.vars]
+    for solution in solutions:
+        # names a cube leaves free are left out
+        yield dict(
+            (name, solution[name]) for name in names if name in solution
+        )
 
 
-def dnf(expr):
+def dnf(expr, stream=False):
+    if stream:
+        return _dnf_stream(expr)
     return expr.dnf()
 
 
-def sat(expr, n=None):
+def _dnf_stream(expr):
+    # terms one at a time, contradictory ones never get built. a term is
+    # only yielded from the first path that gives it, found by searching
+    # again for just the terms within it rather than keeping those seen,
+    # so memory stays bounded by the expression's size.
+    index = dict((v, i) for i, v in enumerate(expr.vars))
+    for term, path in _terms(expr):
+        first = next(
+            p for t, p in _terms(expr, within=term) if len(t) == len(term)
+        )
+        if first != path:
+            continue
+        yield and_(
+            v if term[v] else not_(v) for v in sorted(term, key=index.get)
+        )
+
+
+def _terms(expr, within=None):
+    # (term, path) for each term as {var: value}, path being the disjuncts
+    # chosen for it. a backtracking search w/ an explicit stack: an and's
+    # sub-expressions are goals met one after another (so terms come
+    # odometer style), an or leaves a choice point whose disjuncts are
+    # tried in turn. w/ within, only terms inside it are.
+    # choice points are (goals, term, path, or, next disjunct), goals a
+    # linked list (expr, rest) they share.
+    stack = [((expr, None), {}, (), None, 0)]
+    while stack:
+        goals, term, path, e, i = stack.pop()
+        if e is not None:
+            if i + 1 < len(e):
+                stack.append((goals, term, path, e, i + 1))
+            goals, term, path = (e[i], goals), dict(term), path + (i,)
+        while goals is not None:
+            e, goals = goals
+            if isinstance(e, Variable):
+                v, val = e, True
+            elif isinstance(e, Not) and isinstance(e.expr, Variable):
+                v, val = e.expr, False
+            elif isinstance(e, Not):
+                goals = (~e.expr, goals)
+                continue
+            elif isinstance(e, And):
+                for sub_e in reversed(e.exprs):
+                    goals = (sub_e, goals)
+                continue
+            elif isinstance(e, Or):
+                if len(e):
+                    stack.append((goals, term, path, e, 0))
+                break
+            else:
+                raise ValueError('{0} invalid'.format(e))
+            if term.get(v, val) != val or (
+                    within is not None and within.get(v) != val):
+                break
+            term[v] = val
+        else:
+            yield term, path
+
+
+def clauses(cnf_expr):
+    if not isinstance(cnf_expr, Expression):
+        # a clause store, see dimacs
+        return list(cnf_expr.vars), [list(c) for c in cnf_expr]
+    if not isinstance(cnf_expr, And):
+        cnf_expr = and_(cnf_expr)
+    cnf_expr = cnf_expr.collapse()
+    vars = list(cnf_expr.vars)
+    index = dict((v, i) for i, v in enumerate(vars))
+
+    def _lit(e):
+        if isinstance(e, Not):
+            return 2 * index[e.expr] + 1
+        return 2 * index[e]
+
+    return vars, [
+        [_lit(e) for e in (clause if isinstance(clause, Or) else [clause])]
+        for clause in cnf_expr
+    ]
+
+
+class Simplification(object):
+
+    # units, pure literals, tautologies, duplicate and subsumed clauses are
+    # eliminated from a cnf. the steps that fix vars are kept so models of
+    # what's left extend back to all models of the original.
+
+    def __init__(self, cnf_expr):
+        vars, lits = clauses(cnf_expr)
+        self.vars, self.steps, self.unsat = vars, [], False
+        cs = set(
+            frozenset(c) for c in lits if not any(l ^ 1 in c for l in c)
+        )
+        self.unsat = frozenset() in cs
+        while not self.unsat:
+            cs = self._units(cs)
+            if self.unsat:
+                break
+            cs, pure = self._pure(cs)
+            if pure:
+                continue
+            size = len(cs)
+            cs = self._subsume(cs)
+            if len(cs) == size:
+                break
+        self.clauses = [] if self.unsat else sorted(sorted(c) for c in cs)
+        fixed = set(step[1] >> 1 for step in self.steps)
+        used = set(l >> 1 for c in self.clauses for l in c)
+        for v in xrange(len(vars)):
+            if v not in fixed and v not in used:
+                self.steps.append(('free', 2 * v))
+
+    def _units(self, cs):
+        while True:
+            units = set(next(iter(c)) for c in cs if len(c) == 1)
+            if not units:
+                return cs
+            if any(l ^ 1 in units for l in units):
+                self.unsat = True
+                return cs
+            self.steps.extend(('unit', l) for l in sorted(units))
+            falses = frozenset(l ^ 1 for l in units)
+            cs = set(c - falses for c in cs if not c & units)
+            if frozenset() in cs:
+                self.unsat = True
+                return cs
+
+    def _pure(self, cs):
+        present = set(l for c in cs for l in c)
+        pure = sorted(l for l in present if l ^ 1 not in present)
+        for lit in pure:
+            removed = [c for c in cs if lit in c]
+            self.steps.append(('pure', lit, removed))
+            cs.difference_update(removed)
+        return cs, pure
+
+    def _subsume(self, cs):
+        occurs = collections.defaultdict(set)
+        for c in cs:
+            for l in c:
+                occurs[l].add(c)
+        for c in sorted(cs, key=len):
+            if c not in cs:
+                continue
+            l = min(c, key=lambda l: len(occurs[l]))
+            for d in list(occurs[l]):
+                if d is not c and c <= d:
+                    cs.discard(d)
+                    for m in d:
+                        occurs[m].discard(d)
+        return cs
+
+    @property
+    def expr(self):
+        if self.unsat or not self.clauses:
+            return None
+
+        def _lit(l):
+            return not_(self.vars[l >> 1]) if l & 1 else self.vars[l >> 1]
+
+        return and_(or_(map(_lit, c)) for c in self.clauses)
+
+    def extend(self, solutions, cubes=False):
+        # w/ cubes, solutions and free steps leave vars out and a pure
+        # literal's var is split on while a clause it removed is undecided
+        names = [v.name for v in self.vars]
+
+        def _value(s, l):
+            val = s.get(names[l >> 1])
+            return None if val is None else val != bool(l & 1)
+
+        def _satisfying(s, cs):
+            # disjoint sub-cubes of s w/ a true literal in each of cs
+            stack = [s]
+            while stack:
+                s = stack.pop()
+                for c in cs:
+                    c = list(c)
+                    vals = [_value(s, l) for l in c]
+                    if True in vals:
+                        continue
+                    if None in vals:
+                        name = names[c[vals.index(None)] >> 1]
+                        for val in (False, True):
+                            t = dict(s)
+                            t[name] = val
+                            stack.append(t)
+                    break
+                else:
+                    yield s
+
+        for solution in solutions:
+            stack = [(len(self.steps), dict(solution))]
+            while stack:
+                i, s = stack.pop()
+                if i == 0:
+                    yield s
+                    continue
+                step = self.steps[i - 1]
+                name, val = names[step[1] >> 1], not step[1] & 1
+                if step[0] == 'free' and cubes:
+                    stack.append((i - 1, s))
+                    continue
+                if step[0] == 'free':
+                    t = dict(s)
+                    t[name] = not val
+                    stack.append((i - 1, t))
+                elif step[0] == 'pure':
+                    t = dict(s)
+                    t[name] = not val
+                    stack.extend((i - 1, u) for u in _satisfying(t, step[2]))
+                s[name] = val
+                stack.append((i - 1, s))
+
+
+def simplify(cnf_expr):
+    return Simplification(cnf_expr)
+
+
+def sat(expr, n=None, mode='distribute'):
 
     def _2sat(cnf_expr):
         exprs = []
@@ -333,7 +794,7 @@ def sat(expr, n=None):
                 else:
                     es, le = [], None
                     for i in range(0, len(expr), 2):
-                        se = expr[i:i + 2]
+                        se = list(expr[i:i + 2])
                         if le is None:
                             if i + 2 >= len(expr):
                                 se.extend([se[0]] * (3 - len(se)))
@@ -352,7 +813,9 @@ def sat(expr, n=None):
             exprs.append(expr)
         return and_(exprs)
 
-    cnf_expr = cnf(expr).collapse()
+    if not isinstance(expr, Expression):
+        expr = expr.expr
+    cnf_expr = cnf(expr, mode).collapse()
     if n is None:
         n = 2 if max(len(clause.vars) for clause in cnf_expr) < 3 else 3
     if n == 2:
@@ -1,10 +1,133 @@
+import os
+import re
+import sys
+
 from ply import lex, yacc
 
 from . import var, and_, or_, not_
 
 
-def parse(data):
-    return yacc.parse(data)
+# lexer and parser are built on first use. the parser's tables are cached
+# next to this module (nsat/parsetab.py) and only used when their signature
+# matches the rules, they're (re)written only if that directory's writable
+# (i.e. not on a read-only install). the lexer is cheap, so it's built from
+# the rules every time rather than from a cache that's never checked.
+_parser = [None, None]
+
+
+def _build():
+    if _parser[0] is None:
+        module = sys.modules[__name__]
+        outputdir = os.path.dirname(os.path.abspath(__file__))
+        _parser[:] = [
+            lex.lex(module=module),
+            yacc.yacc(
+                module=module, debug=0, tabmodule='nsat.parsetab',
+                outputdir=outputdir, errorlog=yacc.NullLogger(),
+                write_tables=os.access(outputdir, os.W_OK),
+            ),
+        ]
+    return _parser
+
+
+def parse(data, mode='flat'):
+    if mode == 'flat':
+        return _parse(data)
+    if mode == 'ply':
+        lexer, parser = _build()
+        return parser.parse(data, lexer=lexer)
+    raise ValueError('mode={0} invalid'.format(mode))
+
+
+class ParseError(ValueError):
+
+    def __init__(self, msg, pos):
+        super(ParseError, self).__init__('{0} at {1}'.format(msg, pos))
+        self.pos = pos
+
+
+# flat, i.e. runs of the same op (and symbol) are one n-ary node instead of
+# a left-leaning chain of binary ones. and & or share a precedence and are
+# left associative, not binds tightest, as in the rules below.
+
+_token = re.compile(
+    r'[ \t\n]*(?:'
+    r'(?P<VAR>[a-zA-Z_][a-zA-Z0-9_]*)|'
+    r'(?P<AND>\&{1,2})|'
+    r'(?P<OR>\|{1,2})|'
+    r'(?P<NOT>\!|\~)|'
+    r'(?P<LPAREN>\()|'
+    r'(?P<RPAREN>\))'
+    r')?'
+)
+
+_ops = {'AND': and_, 'OR': or_}
+
+
+def _tokenize(data):
+    for m in _token.finditer(data):
+        kind = m.lastgroup
+        if kind is None:
+            if m.end() != len(data):
+                raise ParseError(
+                    'illegal character {0!r}'.format(data[m.end()]), m.end(),
+                )
+            return
+        value = m.group(kind)
+        if kind == 'VAR':
+            kind = reserved.get(value, kind)
+        yield kind, value, m.start(kind)
+
+
+def _reduce(frame):
+    es, op = frame[0], frame[1]
+    if op is None:
+        return es[0]
+    return _ops[op[0]](es, symbol=op[1])
+
+
+def _parse(data):
+    # a frame per open paren, [operands of the current run, its op, the op
+    # after it, nots pending on the next operand, paren position]
+    frames = [[None, None, None, 0, None]]
+    operand, vars = True, {}
+    for kind, value, pos in _tokenize(data):
+        frame = frames[-1]
+        if operand:
+            if kind == 'NOT':
+                frame[3] += 1
+                continue
+            if kind == 'LPAREN':
+                frames.append([None, None, None, 0, pos])
+                continue
+            if kind != 'VAR':
+                raise ParseError('unexpected {0!r}'.format(value), pos)
+            e = vars.get(value)
+            if e is None:
+                e = vars[value] = var(value)
+        else:
+            if kind in _ops:
+                frame[2], operand = (kind, value), True
+                continue
+            if kind != 'RPAREN' or len(frames) == 1:
+                raise ParseError('unexpected {0!r}'.format(value), pos)
+            e = _reduce(frames.pop())
+            frame = frames[-1]
+        for _ in xrange(frame[3]):
+            e = not_(e)
+        frame[3] = 0
+        if frame[0] is None:
+            frame[0] = [e]
+        elif frame[1] == frame[2]:
+            frame[0].append(e)
+        else:
+            frame[0], frame[1] = [_reduce(frame), e], frame[2]
+        operand = False
+    if operand:
+        raise ParseError('unexpected end', len(data))
+    if len(frames) > 1:
+        raise ParseError('unclosed paren', frames[-1][4])
+    return _reduce(frames[0])
 
 
 # tokens
@@ -48,9 +171,6 @@ def t_error(t):
     t.lexer.skip(1)
 
 
-lex.lex()
-
-
 # rules
 
 precedence = (
@@ -93,6 +213,3 @@ def p_expression_bop(t):
 
 def p_error(t):
     print("Syntax error at '%s'" % t.value)
-
-
-yacc.yacc(debug=0, write_tables=0)
@@ -0,0 +1,34 @@
+import itertools
+
+
+# ones' complement, i.e. what tcp checks: sums fold their carries back in
+# and 0xffff (-0) is the same as 0
+
+
+def fold(total):
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return total % 0xffff
+
+
+_tables = {}
+
+
+def table(n, count):
+    # checksums of a group of count 2-bit fields, each the number of true
+    # literals in a clause of n, that are all non-zero
+    key = (n, count)
+    if key not in _tables:
+        _tables[key] = frozenset(
+            fold(sum(part << (i * 2) for i, part in enumerate(parts)))
+            for parts in itertools.product(*([range(1, n + 1)] * count))
+        )
+    return _tables[key]
+
+
+def checksums((data, checksums)):
+    n = len(data) // len(checksums)
+    return data, all(
+        fold(sum(data[g * n:(g + 1) * n])) in group
+        for g, group in enumerate(checksums)
+    )
@@ -0,0 +1,120 @@
+import functools
+import itertools
+
+from .expression import Not
+from .matcher import fold, table
+
+
+class Packing(object):
+
+    # a candidate is an int w/ bit i set when var i is true, its data is
+    # groups of 16-bit words w/ a 2-bit field per clause and one word per
+    # literal position. the words of a group sum to a checksum when each
+    # of its clauses has a true literal.
+
+    def __init__(self, sat_expr):
+        vars = sat_expr.vars
+        index = dict((v, i) for i, v in enumerate(vars))
+        self.names = tuple(v.name for v in vars)
+        self.n = len(sat_expr.exprs[0])
+        # 8 fields of 3 would sum to 0xffff, which is -0 and so the same
+        # checksum as no true literals at all
+        self.fields = 8 if self.n == 2 else 7
+        self.lits = tuple(
+            tuple((index[e.var], isinstance(e, Not)) for e in clause)
+            for clause in sat_expr
+        )
+        self.groups = -(-len(self.lits) // self.fields)
+        occurrences = [[] for _ in vars]
+        for i, clause in enumerate(self.lits):
+            g, field = self.field(i)
+            for j, (v, neg) in enumerate(clause):
+                occurrences[v].append((g * self.n + j, field, neg, g))
+        self.occurrences = tuple(tuple(occ) for occ in occurrences)
+        self.size = 1 << len(self.names)
+
+    def field(self, i):
+        g, f = divmod(i, self.fields)
+        return g, 0b01 << (f * 2)
+
+    def checksums(self):
+        counts = [self.fields] * (len(self.lits) // self.fields)
+        if len(self.lits) % self.fields:
+            counts.append(len(self.lits) % self.fields)
+        return [table(self.n, count) for count in counts]
+
+    def data(self, candidate):
+        d = [0] * (self.n * self.groups)
+        for i, clause in enumerate(self.lits):
+            g, field = self.field(i)
+            for j, (v, neg) in enumerate(clause):
+                if (candidate >> v) & 1 != neg:
+                    d[g * self.n + j] |= field
+        return d
+
+    def totals(self, data):
+        return [
+            sum(data[g * self.n:(g + 1) * self.n])
+            for g in xrange(self.groups)
+        ]
+
+    def expand(self, lo=0, hi=None):
+        # visits indexes [lo, hi) in gray code order so consecutive
+        # candidates differ by one var and only its fields are updated,
+        # data and group totals are updated in place
+        hi = self.size if hi is None else hi
+        if lo >= hi:
+            return
+        candidate = lo ^ (lo >> 1)
+        data = self.data(candidate)
+        totals = self.totals(data)
+        yield candidate, data, totals
+        for i in xrange(lo + 1, hi):
+            v = (i & -i).bit_length() - 1
+            candidate ^= 1 << v
+            val = (candidate >> v) & 1
+            for j, field, neg, g in self.occurrences[v]:
+                data[j] ^= field
+                totals[g] += field if val != neg else -field
+            yield candidate, data, totals
+
+    def matches(self, match, checksums, lo=0, hi=None):
+        # w/o a match, accept candidates whose running group sums are all
+        # checksums
+        if match is None:
+            for candidate, _, totals in self.expand(lo, hi):
+                if all(
+                        fold(t) in group
+                        for t, group in zip(totals, checksums)
+                        ):
+                    yield candidate
+        else:
+            # a match w/ an imap (e.g. checksums_http) gets candidates as a
+            # stream so it can work on many at once, results are in order
+            imap = getattr(match, 'imap', None)
+            if imap is None:
+                imap = functools.partial(itertools.imap, match)
+            expanded, pairs = itertools.tee(self.expand(lo, hi))
+            # data is updated in place, so each gets a copy of its own
+            results = imap((data[:], checksums) for _, data, _ in pairs)
+            try:
+                for (candidate, _, _), (_, matched) in itertools.izip(
+                        expanded, results,
+                        ):
+                    if matched:
+                        yield candidate
+            finally:
+                if hasattr(results, 'close'):
+                    results.close()
+
+    def ranges(self, size):
+        lo = 0
+        while lo < self.size:
+            yield lo, min(lo + size, self.size)
+            lo += size
+
+    def assignment(self, candidate):
+        return dict(
+            (name, bool((candidate >> i) & 1))
+            for i, name in enumerate(self.names)
+        )
@@ -0,0 +1,207 @@
+import collections
+import functools
+import itertools
+
+from .dimacs import Clauses
+from .executor import Executor
+from .expression import (
+    Expression, And, and_, cnf, clauses, project, simplify,
+)
+
+
+def expand(cubes, expr):
+    # full assignments to expr's vars, those a cube leaves out can be either
+    names = [var.name for var in expr.vars]
+    for cube in cubes:
+        missing = [name for name in names if name not in cube]
+        for vals in itertools.product((True, False), repeat=len(missing)):
+            solution = dict(cube)
+            solution.update(zip(missing, vals))
+            yield solution
+
+
+def implicant(clauses, value, lits=()):
+    # lits plus literals true under value (per literal) until every clause
+    # has one, those w/ the fewest true literals pick first
+    lits = set(lits)
+    for clause in sorted(clauses, key=lambda c: sum(value[l] for l in c)):
+        if not any(l in lits for l in clause):
+            lits.add(next(l for l in clause if value[l]))
+    return lits
+
+
+def _cover(solutions, cnf_expr):
+    # each model not in an earlier cube is shrunk to a cube that satisfies
+    # every clause and conflicts w/ every earlier cube, so cubes are
+    # disjoint and together hold exactly the models
+    vars, lits = clauses(cnf_expr)
+    names = [var.name for var in vars]
+    blocks = []
+    for solution in solutions:
+        value = [None] * (2 * len(names))
+        for i, name in enumerate(names):
+            value[2 * i] = solution[name]
+            value[2 * i + 1] = not solution[name]
+        if any(not any(value[l] for l in block) for block in blocks):
+            continue
+        cube = implicant(lits + blocks, value)
+        blocks.append([l ^ 1 for l in cube])
+        yield dict((names[l >> 1], not l & 1) for l in cube)
+
+
+def components(cnf_expr):
+    # variable-disjoint groups of clauses, each a cnf (or clause store) of
+    # its own
+    vars, lits = clauses(cnf_expr)
+    parent = range(len(vars))
+
+    def _find(v):
+        while parent[v] != v:
+            parent[v] = parent[parent[v]]
+            v = parent[v]
+        return v
+
+    for clause in lits:
+        for l in clause[1:]:
+            a, b = _find(clause[0] >> 1), _find(l >> 1)
+            if a != b:
+                parent[a] = b
+    groups = collections.OrderedDict()
+    for i, clause in enumerate(lits):
+        key = _find(clause[0] >> 1) if clause else None
+        groups.setdefault(key, []).append(i)
+    for group in groups.itervalues():
+        if isinstance(cnf_expr, Expression):
+            yield and_(cnf_expr[i] for i in group)
+            continue
+        index = {}
+        for i in group:
+            for l in lits[i]:
+                index.setdefault(l >> 1, len(index))
+        yield Clauses(
+            [vars[v].name for v in index],
+            [[2 * index[l >> 1] + (l & 1) for l in lits[i]] for i in group],
+        )
+
+
+def product(streams):
+    # merged solutions of each combination, the first stream is read once
+    # and the others cached as they're first read, so nothing waits on a
+    # whole stream before the first solution
+    if not streams:
+        yield {}
+        return
+    rest = [iter(stream) for stream in streams[1:]]
+    caches = [[] for _ in rest]
+
+    def _get(k, i):
+        cache = caches[k]
+        if i == len(cache) and rest[k] is not None:
+            for solution in rest[k]:
+                cache.append(solution)
+                break
+            else:
+                rest[k] = None
+        return cache[i] if i < len(cache) else None
+
+    for head in streams[0]:
+        items = [_get(k, 0) for k in xrange(len(rest))]
+        if None in items:
+            return
+        indexes = [0] * len(rest)
+        while True:
+            solution = dict(head)
+            for item in items:
+                solution.update(item)
+            yield solution
+            k = len(rest) - 1
+            while k >= 0:
+                indexes[k] += 1
+                items[k] = _get(k, indexes[k])
+                if items[k] is not None:
+                    break
+                indexes[k], items[k] = 0, caches[k][0]
+                k -= 1
+            if k < 0:
+                break
+
+
+def solver(f=None, cubes=False):
+    # wraps f(cnf_expr, ...), which yields solutions over the cnf's vars, w/
+    # conversion, optional simplification and projection back onto expr.
+    # a clause store (see dimacs) is already a cnf and passed as is.
+    #
+    # w/ cubes=True solutions are partial, vars left out are free. f yields
+    # them itself when it takes cubes=, otherwise its models are covered.
+    #
+    # w/ decompose=True each variable-disjoint component is solved on its
+    # own and solutions are their product. w/ parallel=True too, components
+    # share one executor rather than each starting a pool.
+    #
+    # w/ limit=n (or first=True, i.e. 1) solving stops after n solutions
+    # (cubes if cubes=True) and everything under it is closed, which stops
+    # executor jobs and probes.
+    if f is None:
+        return functools.partial(solver, cubes=cubes)
+
+    def _solutions(cnf_expr, args, kwargs, as_cubes, decompose=False):
+        if decompose:
+            return product([
+                _solutions(component, args, kwargs, as_cubes)
+                for component in components(cnf_expr)
+            ])
+        if not as_cubes:
+            return f(cnf_expr, *args, **kwargs)
+        if cubes:
+            return f(cnf_expr, *args, cubes=True, **kwargs)
+        return _cover(f(cnf_expr, *args, **kwargs), cnf_expr)
+
+    @functools.wraps(f)
+    def _solve(expr, *args, **kwargs):
+        mode = kwargs.pop('mode', 'distribute')
+        as_cubes = kwargs.pop('cubes', False)
+        decompose = kwargs.pop('decompose', False)
+        limit = kwargs.pop('limit', None)
+        if kwargs.pop('first', False):
+            limit = 1
+        if isinstance(expr, Expression):
+            cnf_expr = cnf(expr, mode)
+            if not isinstance(cnf_expr, And):
+                cnf_expr = and_(cnf_expr)
+            cnf_expr = cnf_expr.collapse()
+        else:
+            cnf_expr = expr
+        executor = None
+        if decompose and kwargs.get('parallel') is True:
+            executor = kwargs['parallel'] = Executor()
+        solutions = None
+        try:
+            if kwargs.pop('simplify', False):
+                simplified = simplify(cnf_expr)
+                if simplified.unsat:
+                    solutions = iter([])
+                elif simplified.expr is None:
+                    solutions = simplified.extend([{}], as_cubes)
+                else:
+                    solutions = simplified.extend(_solutions(
+                        simplified.expr, args, kwargs, as_cubes, decompose,
+                    ), as_cubes)
+            else:
+                solutions = _solutions(
+                    cnf_expr, args, kwargs, as_cubes, decompose,
+                )
+            if not as_cubes:
+                # vars in no clause
+                solutions = expand(solutions, expr)
+            solutions = project(solutions, expr)
+            for solution in itertools.islice(solutions, limit):
+                yield solution
+        finally:
+            try:
+                if solutions is not None and hasattr(solutions, 'close'):
+                    solutions.close()
+            finally:
+                if executor is not None:
+                    executor.terminate()
+
+    return _solve
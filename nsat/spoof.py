@@ -1,9 +1,230 @@
+import array
+import collections
 import contextlib
+import ctypes
+import errno
+import heapq
 import httplib
+import itertools
+import os
+import random
+import select
+import socket
 import StringIO
+import struct
+import sys
 import time
 
-from scapy import all as scapy
+
+def fold(total):
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+
+def checksum_sum(data):
+    # ones' complement sum of data's big-endian 16-bit words
+    data = bytes(data)
+    if len(data) % 2:
+        data += b'\0'
+    words = array.array(b'H', data)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return fold(sum(words))
+
+
+def update(checksum, old, new):
+    # rfc 1624 eqn. 3, HC' = ~(~HC + ~m + m'). old and new are 16-bit
+    # words, or ones' complement sums of what's replaced.
+    return ~fold((~checksum & 0xffff) + (~old & 0xffff) + new) & 0xffff
+
+
+FLAGS = dict(F=0x01, S=0x02, R=0x04, P=0x08, A=0x10, U=0x20)
+
+
+class Segment(object):
+
+    # an ip + tcp header for one connection built once, seq, ack, flags and
+    # payload are then patched in place. both checksums are kept current w/
+    # incremental updates rather than recomputed.
+
+    size = 40
+
+    def __init__(self, src, dst, sport, dport, window=8192):
+        self.header = bytearray(self.size)
+        struct.pack_into(
+            b'!BBHHHBBH4s4s', self.header, 0,
+            0x45, 0, self.size, 0, 0x4000, 64, socket.IPPROTO_TCP, 0,
+            socket.inet_aton(src), socket.inet_aton(dst),
+        )
+        struct.pack_into(
+            b'!HHIIHHHH', self.header, 20,
+            sport, dport, 0, 0, 5 << 12, window, 0, 0,
+        )
+        self.payload, self.payload_sum = b'', 0
+        struct.pack_into(
+            b'!H', self.header, 10, ~checksum_sum(self.header[:20]) & 0xffff,
+        )
+        # pseudo header, i.e. addresses, protocol and tcp length
+        pseudo = checksum_sum(
+            self.header[12:20] +
+            struct.pack(b'!HH', socket.IPPROTO_TCP, self.size - 20)
+        )
+        self.checksum = ~fold(pseudo + checksum_sum(self.header[20:])) & 0xffff
+        struct.pack_into(b'!H', self.header, 36, self.checksum)
+
+    def _patch(self, offset, fmt, value):
+        # a word aligned tcp header field
+        n = struct.calcsize(fmt) // 2
+        old = struct.unpack_from(b'!{0}H'.format(n), self.header, offset)
+        struct.pack_into(fmt, self.header, offset, value)
+        new = struct.unpack_from(b'!{0}H'.format(n), self.header, offset)
+        for o, w in zip(old, new):
+            self.checksum = update(self.checksum, o, w)
+        struct.pack_into(b'!H', self.header, 36, self.checksum)
+
+    def set(self, seq=None, ack=None, flags=None, payload=None):
+        if seq is not None:
+            self._patch(24, b'!I', seq & 0xffffffff)
+        if ack is not None:
+            self._patch(28, b'!I', ack & 0xffffffff)
+        if flags is not None:
+            if isinstance(flags, basestring):
+                flags = sum(FLAGS[f] for f in flags)
+            self._patch(32, b'!H', 5 << 12 | flags)
+        if payload is not None and payload != self.payload:
+            payload = bytes(payload)
+            old, new = self.size + len(self.payload), self.size + len(payload)
+            # ip total length
+            struct.pack_into(b'!H', self.header, 2, new)
+            struct.pack_into(b'!H', self.header, 10, update(
+                struct.unpack_from(b'!H', self.header, 10)[0], old, new,
+            ))
+            # tcp length (in the pseudo header) and the payload itself
+            payload_sum = checksum_sum(payload)
+            self.checksum = update(
+                update(self.checksum, old - 20, new - 20),
+                self.payload_sum, payload_sum,
+            )
+            struct.pack_into(b'!H', self.header, 36, self.checksum)
+            self.payload, self.payload_sum = payload, payload_sum
+        return self
+
+    def packet(self, checksum=None):
+        header = self.header
+        if checksum is not None:
+            header = bytearray(header)
+            struct.pack_into(b'!H', header, 36, checksum)
+        return bytearray(header + self.payload)
+
+
+def source(dst):
+    # local address routed to dst
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((dst, 9))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+SO_ATTACH_FILTER = 26
+
+
+def bpf(src, sport, dport=None):
+    # classic bpf for a raw tcp socket (its data starts at the ip header)
+    # that only accepts segments from src:sport (to dport)
+    program = [
+        # ld [12], the ip source
+        (0x20, 0, 0, 12),
+        (0x15, 0, None, struct.unpack(b'!I', socket.inet_aton(src))[0]),
+        # ldxb 4 * ([0] & 0xf), the ip header's length, then the ports
+        (0xb1, 0, 0, 0),
+        (0x48, 0, 0, 0),
+        (0x15, 0, None, sport),
+    ]
+    if dport is not None:
+        program.extend([(0x48, 0, 0, 2), (0x15, 0, None, dport)])
+    # ret whole packet, ret 0 (i.e. drop)
+    program.extend([(0x06, 0, 0, 0xffff), (0x06, 0, 0, 0)])
+    return [
+        (code, jt, len(program) - i - 2 if jf is None else jf, k)
+        for i, (code, jt, jf, k) in enumerate(program)
+    ]
+
+
+def attach(sock, program):
+    code = ctypes.create_string_buffer(b''.join(
+        struct.pack(b'HBBI', *ins) for ins in program
+    ))
+    sock.setsockopt(
+        socket.SOL_SOCKET, SO_ATTACH_FILTER,
+        struct.pack(b'HP', len(program), ctypes.addressof(code)),
+    )
+
+
+class RawSocket(object):
+
+    # segments out to host:port and in from it (to sport, if given) over
+    # raw sockets. a bpf filter drops everything else in the kernel, so
+    # other connections' traffic isn't even copied to us, and segments are
+    # read into one preallocated buffer.
+
+    def __init__(self, host, port, sport=None):
+        self.dst = host
+        self.dport = port
+        self.sport = sport
+        self.addr = socket.inet_aton(host)
+        self.buf = bytearray(0xffff)
+        self.outs = socket.socket(
+            socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW,
+        )
+        try:
+            self.ins = socket.socket(
+                socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_TCP,
+            )
+            self.ins.setblocking(False)
+            attach(self.ins, bpf(host, port, sport))
+        except:
+            self.close()
+            raise
+
+    def fileno(self):
+        return self.ins.fileno()
+
+    def send(self, packet):
+        self.outs.sendto(bytes(packet), (self.dst, 0))
+
+    def recv(self):
+        # the next segment waiting as (dport, seq, ack, flags, payload),
+        # None if there's none. anything queued before the filter was
+        # attached is checked here.
+        while True:
+            try:
+                n = self.ins.recv_into(self.buf)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return None
+                raise
+            off = (self.buf[0] & 0x0f) * 4
+            if n < off + 20 or self.buf[12:16] != self.addr:
+                continue
+            sport, dport, seq, ack, flags = struct.unpack_from(
+                b'!HHIIH', self.buf, off,
+            )
+            if sport != self.dport or self.sport not in (None, dport):
+                continue
+            return (
+                dport, seq, ack, flags & 0x3f,
+                bytes(self.buf[off + (flags >> 12) * 4:n]),
+            )
+
+    def close(self):
+        try:
+            if hasattr(self, 'ins'):
+                self.ins.close()
+        finally:
+            self.outs.close()
 
 
 class Connection(object):
@@ -15,34 +236,25 @@ class Connection(object):
         self.sport = None
         self.rseq = None
         self.wseq = None
+        self.segment = None
         self.verbose = verbose
 
     def open(self):
-        self.sock = scapy.L3RawSocket()
+        self.sport = random.randint(1024, 0xffff)
+        self.sock = RawSocket(self.dst, self.dport, self.sport)
         try:
-            # syn
-            tcp = scapy.TCP(
-                dport=self.dport,
-                sport=scapy.RandShort(),
-                flags='S',
+            self.segment = Segment(
+                source(self.dst), self.dst, self.sport, self.dport,
             )
-            p = self.sock.sr1(
-                scapy.IP(dst=self.dst) / tcp,
-                verbose=self.verbose,
-            )
-            self.sport = p[scapy.TCP].dport
-            self.wseq = p[scapy.TCP].ack
-            self.rseq = p[scapy.TCP].seq
+
+            # syn
+            self._send(self.sendp(
+                flags='S', seq=random.getrandbits(32), ack=0,
+            ))
+            _, self.rseq, self.wseq, _, _ = self._reply()
 
             # ack
-            tcp = scapy.TCP(
-                dport=self.dport,
-                sport=self.sport,
-                seq=self.wseq,
-                ack=self.rseq + 1,
-                flags='A',
-            )
-            self.sock.send(scapy.IP(dst=self.dst) / tcp)
+            self._send(self.sendp(flags='A', ack=self.rseq + 1))
         except:
             self.sock.close()
             self.sock = None
@@ -57,112 +269,111 @@ class Connection(object):
 
         return _close()
 
-    def sendp(self, payload):
-        tcp = scapy.TCP(
-            dport=self.dport,
-            sport=self.sport,
-            seq=self.wseq,
-            flags='P',
-        )
-        return scapy.IP(dst=self.dst) / tcp / payload
+    def sendp(self, payload=b'', flags='PA', seq=None, ack=None,
+              checksum=None):
+        # a packet (bytearray) from the connection's segment, checksum
+        # overrides the tcp checksum. linux drops data w/o an ack, so it
+        # acks what's been read by default.
+        return self.segment.set(
+            seq=self.wseq if seq is None else seq,
+            ack=self.rseq + 1 if ack is None else ack,
+            flags=flags,
+            payload=payload,
+        ).packet(checksum)
+
+    def checksum(self, payload, flags='PA', seq=None, ack=None):
+        # tcp checksum payload would be sent w/
+        return self.segment.set(
+            seq=self.wseq if seq is None else seq,
+            ack=self.rseq + 1 if ack is None else ack,
+            flags=flags,
+            payload=payload,
+        ).checksum
+
+    def _send(self, p):
+        self.sock.send(p)
+
+    def _reply(self, timeout=None):
+        # next segment to us on this connection as (dport, seq, ack, flags,
+        # payload), None on timeout
+        expires_at = time.time() + timeout if timeout else None
+        while True:
+            remaining = None
+            if expires_at is not None:
+                remaining = expires_at - time.time()
+                if remaining <= 0:
+                    return None
+            if not select.select([self.sock], [], [], remaining)[0]:
+                return None
+            r = self.sock.recv()
+            if r is not None:
+                return r
 
     def send(self, p, timeout=None):
-        if not isinstance(p, scapy.Packet):
+        if not isinstance(p, bytearray):
             p = self.sendp(p)
-        r = self.sock.sr1(p, timeout=timeout, verbose=self.verbose)
-        if not r:
+        self._send(p)
+        if not self._reply(timeout):
             return False
-        self.wseq += len(p[scapy.TCP].payload)
+        self.wseq += len(p) - Segment.size
         return True
 
     def recv(self, n=None, timeout=None):
-
-        def lfilter(p):
-            return (
-                p.haslayer(scapy.IP) and
-                p[scapy.IP].dst == self.dst and
-                p.haslayer(scapy.TCP) and
-                p[scapy.TCP].sport == self.dport and
-                p[scapy.TCP].dport == self.sport and
-                p[scapy.TCP].seq not in seqs
-            )
-
-        def prn(p):
-            seqs.append(p[scapy.TCP].seq)
-            lens.append(len(p[scapy.TCP].payload))
-
-        def stop_filter(p):
-            return (
-                (expires_at and expires_at < time.time()) or
-                (n and sum(lens) >= n) or
-                (p[scapy.TCP].flags & 1 == 1)
-            )
-
-        seqs, lens, expires_at = (
-            [],
-            [],
-            time.time() + timeout if timeout else None,
-        )
-
-        # recv
-        ps = self.sock.sniff(
-            lfilter=lfilter,
-            prn=prn,
-            stop_filter=stop_filter,
-            timeout=timeout,
-            verbose=self.verbose,
-        )
-
-        payload = ''.join(
-            str(p[scapy.TCP].payload or '') for p in ps
-        )
-
-        # ack
-        rseq = ps[-1][scapy.TCP].seq + len(str(ps[-1][scapy.TCP].payload) or '')
-        tcp = scapy.TCP(
-            dport=self.dport,
-            sport=self.sport,
-            flags='A',
-            seq=self.wseq,
-            ack=rseq + 1,
-        )
-        self.sock.send(scapy.IP(dst=self.dst) / tcp)
-        self.rseq = rseq
-
-        # closed?
-        if ps[-1][scapy.TCP].flags & 1:
+        # payload up to n bytes, or until the peer's fin, each segment's
+        # once (retransmits are dropped by seq)
+        seqs, payloads, size = set(), [], 0
+        expires_at = time.time() + timeout if timeout else None
+        last = None
+        while not (n and size >= n):
+            remaining = None
+            if expires_at is not None:
+                remaining = expires_at - time.time()
+                if remaining <= 0:
+                    break
+            r = self._reply(remaining)
+            if r is None:
+                break
+            _, seq, _, flags, payload = r
+            # bare acks carry nothing
+            if seq in seqs or not (payload or flags & FLAGS['F']):
+                continue
+            seqs.add(seq)
+            payloads.append((seq, payload))
+            size += len(payload)
+            last = r
+            if flags & FLAGS['F']:
+                break
+        if last is None:
+            return b''
+
+        # ack, the peer's fin (which takes a seq) w/ ours
+        _, seq, _, flags, payload = last
+        self.rseq = seq + len(payload) - (not flags & FLAGS['F'])
+        if flags & FLAGS['F']:
+            self._send(self.sendp(flags='FA'))
             self.sock.close()
             self.sock = None
+        else:
+            self._send(self.sendp(flags='A'))
 
-        return payload
+        # in order, w/ seqs relative to the first in case they wrapped
+        first = payloads[0][0]
+        payloads.sort(key=lambda (seq, _): (seq - first) & 0xffffffff)
+        return b''.join(payload for _, payload in payloads)
 
     def close(self):
         if not self.sock:
             return
         try:
             # fin
-            tcp = scapy.TCP(
-                dport=self.dport,
-                sport=self.sport,
-                seq=self.wseq,
-                flags='F'
-            )
-            r = self.sock.sr1(
-                scapy.IP(dst=self.dst) / tcp,
-                verbose=self.verbose,
-            )
-            self.wseq = r[scapy.TCP].ack
-
-            # ack
-            tcp = scapy.TCP(
-                dport=self.dport,
-                sport=self.sport,
-                flags='A',
-                seq=self.wseq,
-                ack=r[scapy.TCP].seq + 1,
-            )
-            self.sock.send(scapy.IP(dst=self.dst) / tcp)
-            self.rseq = r[scapy.TCP].seq
+            self._send(self.sendp(flags='FA'))
+            r = self._reply()
+            self.wseq = r[2]
+
+            # ack, if it's the peer's fin and not just an ack of ours
+            if r[3] & FLAGS['F']:
+                self.rseq = r[1]
+                self._send(self.sendp(flags='A'))
         finally:
             try:
                 self.sock.close()
@@ -171,6 +382,241 @@ class Connection(object):
             self.sock = None
 
 
+class RTO(object):
+
+    # retransmission timeout from a smoothed rtt and its variance
+    # (jacobson/karels, as in rfc 6298) kept w/in [lo, hi], initial until
+    # there's a sample. there's no backoff, a probe timing out is an answer
+    # rather than congestion.
+
+    def __init__(self, initial=1.0, lo=0.01, hi=None):
+        self.lo = lo
+        self.hi = initial if hi is None else hi
+        self.srtt = None
+        self.rttvar = None
+        self.initial = self.value = min(max(initial, self.lo), self.hi)
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2.0
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4.0
+            self.srtt += (rtt - self.srtt) / 8.0
+        self.value = min(max(self.srtt + 4 * self.rttvar, self.lo), self.hi)
+
+
+class Engine(object):
+
+    # many connections to one host over one raw socket w/o threads. a
+    # task is a generator yielding (packet, ack, timeout), packet (if any)
+    # is sent and w/ an ack the task sleeps until a segment acking that
+    # (or a fin or rst) arrives, sent back in as (seq, ack, flags,
+    # payload), or until timeout passes, None. w/o an ack it's resumed
+    # right away. replies are routed by (our port, ack), so one reader
+    # serves every connection.
+    #
+    # once a task sends a fin its port isn't reused until the peer's fin
+    # is acked or linger seconds pass, much like time-wait.
+
+    def __init__(self, host, port, limit=256, linger=5.0):
+        self.dst = host
+        self.dport = port
+        self.src = source(host)
+        self.limit = limit
+        self.linger = linger
+        self.sock = RawSocket(host, port)
+        self.queued = collections.deque()
+        self.ready = collections.deque()
+        # port -> (task, ack, token)
+        self.waits = {}
+        self.timers = []
+        self.tokens = itertools.count()
+        self.ports = set()
+        # ports whose task got the peer's fin, and ports waiting on it
+        self.fins = set()
+        self.closing = {}
+
+    def spawn(self, f, *args):
+        # f(segment, *args) is called once there's room, w/ a segment from
+        # a port of its own, and returns a task (or None to skip it)
+        self.queued.append((f, args))
+
+    def _start(self, f, args):
+        sport = random.randint(1024, 0xffff)
+        while sport in self.ports or sport in self.closing:
+            sport = random.randint(1024, 0xffff)
+        task = f(Segment(self.src, self.dst, sport, self.dport), *args)
+        if task is not None:
+            self.ports.add(sport)
+            self._step((sport, task), None)
+
+    def _step(self, (sport, task), reply):
+        try:
+            packet, ack, timeout = task.send(reply)
+        except StopIteration:
+            self.ports.discard(sport)
+            self.fins.discard(sport)
+            return
+        if packet is not None:
+            self.sock.send(packet)
+            if packet[33] & FLAGS['F'] and sport not in self.fins:
+                token = next(self.tokens)
+                self.closing[sport] = token
+                heapq.heappush(self.timers, (
+                    time.time() + self.linger, token, (sport, None),
+                ))
+        if ack is None:
+            self.ready.append(((sport, task), None))
+            return
+        token = next(self.tokens)
+        self.waits[sport] = ((sport, task), ack & 0xffffffff, token)
+        heapq.heappush(self.timers, (time.time() + timeout, token, sport))
+
+    def _read(self):
+        while True:
+            r = self.sock.recv()
+            if r is None:
+                return
+            dport, seq, ack, flags, payload = r
+            wait = self.waits.get(dport)
+            if wait is not None and (
+                    ack == wait[1] or flags & (FLAGS['F'] | FLAGS['R'])):
+                del self.waits[dport]
+                if flags & FLAGS['F']:
+                    self.fins.add(dport)
+                self.ready.append((wait[0], r[1:]))
+            elif flags & FLAGS['F'] and dport in self.closing:
+                del self.closing[dport]
+                self.sock.send(Segment(
+                    self.src, self.dst, dport, self.dport,
+                ).set(ack, seq + len(payload) + 1, 'A').packet())
+
+    def _expire(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, token, key = heapq.heappop(self.timers)
+            # stale if a reply beat it or the port's waiting again
+            if isinstance(key, tuple):
+                if self.closing.get(key[0]) == token:
+                    del self.closing[key[0]]
+            elif key in self.waits and self.waits[key][2] == token:
+                task, _, _ = self.waits.pop(key)
+                self.ready.append((task, None))
+
+    def run(self, until=None):
+        # until there's nothing left to do or until() is true
+        while self.queued or self.ready or self.waits or self.closing:
+            while self.queued and len(self.ports) < self.limit:
+                self._start(*self.queued.popleft())
+            while self.ready:
+                self._step(*self.ready.popleft())
+            if until is not None and until():
+                return
+            if self.ready or not self.timers:
+                continue
+            timeout = max(0, self.timers[0][0] - time.time())
+            if select.select([self.sock], [], [], timeout)[0]:
+                self._read()
+            self._expire()
+
+    def close(self):
+        # tasks not yet started are dropped, those that are finish so no
+        # connection is left half open
+        self.queued.clear()
+        try:
+            self.run()
+        finally:
+            self.sock.close()
+
+
+def probes(segment, take, put, rto, retry=0):
+    # a task (see Engine) that connects and sends jobs from take(), each
+    # (payload, checksum, done, ...), one after another at the same seq so
+    # one handshake answers many. checksum(segment) (header set) gives the
+    # tcp checksum to send payload w/, e.g. a spoofed one, and done gets
+    # whether it's acked. it stops once one is (the peer has it and
+    # carries on from there), take() is None or the peer closes. a job is
+    # only ever answered by the peer, one that isn't (no handshake or the
+    # peer closes first) is put() back, put(job, True) if the handshake
+    # timed out, and a refused connection raises.
+    # jobs all have the same length, so a late ack for one looks like an
+    # ack for a later one. once a payload's timed out, an ack could be any
+    # earlier one's, so the job is put() back to be tried first on a fresh
+    # connection, along w/ the one that timed out last (done only once the
+    # next one does, in case the ack is its).
+    # syn and payloads are resent retry times. payloads are waited on for
+    # rto's value, which acks of payloads sent once (i.e. unambiguous) are
+    # sampled for, but a syn may wait on a busy listen queue, so it's
+    # waited on from rto's initial value, doubled each time, as tcp does.
+    job = take()
+    if job is None:
+        return
+    isn = random.getrandbits(32)
+    syn = segment.set(isn, 0, 'S', b'').packet()
+    for i in xrange(retry + 1):
+        reply = yield syn, isn + 1, rto.initial * 2 ** i
+        if reply is not None:
+            break
+    if reply is None:
+        put(job, True)
+        return
+    if reply[2] & (FLAGS['S'] | FLAGS['R']) != FLAGS['S']:
+        put(job)
+        if reply[2] & FLAGS['R']:
+            raise socket.error(
+                errno.ECONNREFUSED, os.strerror(errno.ECONNREFUSED),
+            )
+        return
+    seq, rseq = isn + 1, reply[0] + 1
+    yield segment.set(seq, rseq, 'A', b'').packet(), None, None
+
+    timed_out, last = False, None
+    reset = False
+    while job is not None:
+        payload, checksum, done = job[:3]
+        segment.set(seq, rseq, 'PA')
+        c = checksum(segment) if checksum is not None else None
+        p = segment.set(payload=payload).packet(c)
+        ack = (seq + len(payload)) & 0xffffffff
+        for i in xrange(retry + 1):
+            sent = time.time()
+            reply = yield p, ack, rto.value
+            if reply is not None:
+                if not i and not timed_out and reply[1] == ack:
+                    rto.sample(time.time() - sent)
+                break
+        if reply is None:
+            if last is not None:
+                last[2](False)
+            timed_out, last = True, job
+            job = take()
+            continue
+        if reply[1] != ack:
+            # closed (w/o taking the payload)
+            put(job)
+            reset = reply[2] & FLAGS['R']
+            rseq = reply[0] + len(reply[3]) + 1
+            break
+        if timed_out:
+            # the acked one first, it's likelier
+            if last is not None:
+                put(last)
+                last = None
+            put(job)
+        else:
+            done(True)
+        seq = ack
+        if reply[2] & FLAGS['F']:
+            rseq = reply[0] + len(reply[3]) + 1
+        break
+    if last is not None:
+        last[2](False)
+
+    # the engine acks the peer's fin if it's yet to come
+    if not reset:
+        yield segment.set(seq, rseq, 'FA', b'').packet(), None, None
+
+
 def http_get_payload(path, headers=None, data=None):
     headers = headers or {}
     reql = [
@@ -0,0 +1,146 @@
+from .expression import clauses
+from .solver import solver
+
+
+class ImplicationGraph(object):
+
+    def __init__(self, n, clauses):
+        # literal 2 * i is var i, 2 * i + 1 is !var i
+        self.n = n
+        self.edges = [[] for _ in xrange(2 * n)]
+        for a, b in clauses:
+            self.edges[a ^ 1].append(b)
+            self.edges[b ^ 1].append(a)
+
+    def components(self):
+        # tarjan w/ an explicit stack, components numbered in reverse
+        # topological order (i.e. sinks first)
+        edges = self.edges
+        index, low = [None] * len(edges), [0] * len(edges)
+        comp = [None] * len(edges)
+        stack, on_stack = [], [False] * len(edges)
+        count, ncomp = 0, 0
+        for root in xrange(len(edges)):
+            if index[root] is not None:
+                continue
+            work = [(root, 0)]
+            while work:
+                v, i = work[-1]
+                if i == 0:
+                    index[v] = low[v] = count
+                    count += 1
+                    stack.append(v)
+                    on_stack[v] = True
+                descend = False
+                while i < len(edges[v]):
+                    w = edges[v][i]
+                    i += 1
+                    if index[w] is None:
+                        work[-1] = (v, i)
+                        work.append((w, 0))
+                        descend = True
+                        break
+                    if on_stack[w]:
+                        low[v] = min(low[v], index[w])
+                if descend:
+                    continue
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == index[v]:
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        comp[w] = ncomp
+                        if w == v:
+                            break
+                    ncomp += 1
+        return comp, ncomp
+
+
+class Condensation(object):
+
+    def __init__(self, graph):
+        self.n = graph.n
+        self.comp, count = graph.components()
+        self.satisfiable = all(
+            self.comp[2 * i] != self.comp[2 * i + 1] for i in xrange(self.n)
+        )
+        self.dual = [None] * count
+        self.edges = [set() for _ in xrange(count)]
+        for lit, c in enumerate(self.comp):
+            self.dual[c] = self.comp[lit ^ 1]
+            for w in graph.edges[lit]:
+                if self.comp[w] != c:
+                    self.edges[c].add(self.comp[w])
+
+    def models(self):
+        if not self.satisfiable:
+            return
+        value = [None] * len(self.edges)
+        trail = []
+
+        def _assign(c):
+            stack = [c]
+            while stack:
+                c = stack.pop()
+                if value[c] is True:
+                    continue
+                if value[c] is False:
+                    return False
+                value[c], value[self.dual[c]] = True, False
+                trail.append(c)
+                stack.extend(self.edges[c])
+            return True
+
+        def _undo(mark):
+            while len(trail) > mark:
+                c = trail.pop()
+                value[c] = value[self.dual[c]] = None
+
+        def _next(i):
+            while i < self.n and value[self.comp[2 * i]] is not None:
+                i += 1
+            return i
+
+        def _model():
+            return [value[self.comp[2 * i]] for i in xrange(self.n)]
+
+        # for a satisfiable 2-cnf, a literal that propagates w/o conflict
+        # leaves the rest satisfiable so this never dead-ends
+        i = _next(0)
+        if i == self.n:
+            yield _model()
+            return
+        frames = [(i, len(trail), iter((True, False)))]
+        while frames:
+            i, mark, choices = frames[-1]
+            _undo(mark)
+            for choice in choices:
+                lit = 2 * i if choice else 2 * i + 1
+                if _assign(self.comp[lit]):
+                    break
+                _undo(mark)
+            else:
+                frames.pop()
+                continue
+            j = _next(i + 1)
+            if j == self.n:
+                yield _model()
+            else:
+                frames.append((j, len(trail), iter((True, False))))
+
+
+@solver
+def solve_2sat(cnf_expr):
+    vars, lits = clauses(cnf_expr)
+    for clause in lits:
+        if len(clause) > 2:
+            raise ValueError('{0} has too many literals'.format(clause))
+        if not clause:
+            return
+        clause.extend(clause * (2 - len(clause)))
+    condensation = Condensation(ImplicationGraph(len(vars), lits))
+    for vals in condensation.models():
+        yield dict((var.name, val) for var, val in zip(vars, vals))
@@ -0,0 +1,48 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def matches(packing, checksums, block=1 << 14):
+    nvars = len(packing.names)
+
+    # (clause, literal) -> var index & polarity
+    lits = numpy.array(
+        [[v for v, _ in clause] for clause in packing.lits],
+        dtype=numpy.intp,
+    )
+    negs = numpy.array(
+        [[neg for _, neg in clause] for clause in packing.lits],
+        dtype=numpy.uint8,
+    )
+    # clause -> its field in its group's sum
+    fields = numpy.zeros((len(packing.lits), packing.groups), numpy.uint32)
+    for i in xrange(len(packing.lits)):
+        g, field = packing.field(i)
+        fields[i, g] = field
+
+    # bitmaps of folded checksums
+    tables = numpy.zeros((packing.groups, 0xffff), bool)
+    for g, group in enumerate(checksums):
+        tables[g, list(group)] = True
+    groups = numpy.arange(packing.groups)
+
+    # low vars count through a block, the rest are fixed per block
+    k = min(nvars, block.bit_length() - 1)
+    lanes = numpy.arange(1 << k, dtype=numpy.uint32)
+    low = ((lanes[:, None] >> numpy.arange(k, dtype=numpy.uint32)) & 1)
+    low = low.astype(numpy.uint8)
+    for base in xrange(0, packing.size, 1 << k):
+        high = numpy.array(
+            [(base >> i) & 1 for i in xrange(k, nvars)],
+            dtype=numpy.uint8,
+        )
+        bits = numpy.hstack([low, numpy.tile(high, (len(low), 1))])
+        vals = bits[:, lits] ^ negs
+        totals = vals.sum(axis=2, dtype=numpy.uint32).dot(fields)
+        totals = (totals & 0xffff) + (totals >> 16)
+        totals = ((totals & 0xffff) + (totals >> 16)) % 0xffff
+        ok = tables[groups, totals].all(axis=1)
+        for lane in numpy.flatnonzero(ok):
+            yield base | int(lane)
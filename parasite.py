@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import argparse
+import contextlib
 import sys
 
 import nsat
@@ -10,35 +11,101 @@ def nsat_cmd_parser(subparsers):
     nsat_subparsers = nsat_parser.add_subparsers(title='techniques')
 
     parser = nsat_subparsers.add_parser('constraint')
+    parser.add_argument('--no-2sat', action='store_true', default=False)
+    cnf_argument(parser)
     parser.set_defaults(cmd=nsat_contraint_cmd)
 
     parser = nsat_subparsers.add_parser('checksum')
     parser.add_argument('-j', '--parallel', action='store_true', default=False)
+    parser.add_argument('--no-2sat', action='store_true', default=False)
+    cnf_argument(parser)
     parser.set_defaults(cmd=nsat_checksum_cmd)
 
+    parser = nsat_subparsers.add_parser('2sat')
+    cnf_argument(parser)
+    parser.set_defaults(cmd=nsat_2sat_cmd)
+
+    parser = nsat_subparsers.add_parser('cdcl')
+    cnf_argument(parser)
+    parser.set_defaults(cmd=nsat_cdcl_cmd)
+
+    parser = nsat_subparsers.add_parser('count')
+    parser.add_argument(
+        '--cnf', choices=['distribute', 'tseitin'], default='distribute',
+    )
+    parser.set_defaults(cmd=nsat_count_cmd)
+
     parser = nsat_subparsers.add_parser('checksum-http')
     parser.add_argument('--host', default='127.0.0.1')
     parser.add_argument('--port', type=int, default=8080)
     parser.add_argument('--path', default='/')
     parser.add_argument('-t', '--timeout', type=float, default=1.0)
+    parser.add_argument('--min-rto', type=float, default=0.01)
+    parser.add_argument('--max-rto', type=float)
     parser.add_argument('-j', '--parallel', action='store_true', default=False)
     parser.add_argument('-q', '--quiet', action='store_true', default=False)
+    cnf_argument(parser)
     parser.set_defaults(cmd=nsat_checksum_http_cmd)
 
+    parser = nsat_subparsers.add_parser('dimacs')
+    parser.add_argument(
+        '-s', '--solver', choices=['cdcl', '2sat', 'checksum', 'constraint'],
+        default='cdcl',
+    )
+    parser.add_argument('-n', '--models', type=int, default=1)
+    parser.add_argument('--simplify', action='store_true', default=False)
+    parser.add_argument('--decompose', action='store_true', default=False)
+    parser.add_argument('path', nargs='?')
+    parser.set_defaults(cmd=nsat_dimacs_cmd)
+
+
+def cnf_argument(parser):
+    parser.add_argument(
+        '--cnf', choices=['distribute', 'tseitin'], default='distribute',
+    )
+    parser.add_argument('--simplify', action='store_true', default=False)
+    parser.add_argument('--cubes', action='store_true', default=False)
+    parser.add_argument('--decompose', action='store_true', default=False)
+    parser.add_argument('-l', '--limit', type=int, default=None)
+    parser.add_argument('-1', '--first', action='store_true', default=False)
+
 
 def nsat_contraint_cmd(args):
     for line in lines(args):
         expr = nsat.parse(line.strip())
-        for ass in nsat.solve_constraint(expr):
-            print ass
+        for ass in solve(args, expr, nsat.solve_constraint):
+            output(args, ass)
 
 
 def nsat_checksum_cmd(args):
     match = nsat.checksums
+    with executor(args) as parallel:
+        for line in lines(args):
+            expr = nsat.parse(line.strip())
+            for ass in solve(
+                    args, expr, nsat.solve_checksum,
+                    match=match, parallel=parallel,
+                    ):
+                output(args, ass)
+
+
+def nsat_2sat_cmd(args):
+    for line in lines(args):
+        expr = nsat.parse(line.strip())
+        for ass in nsat.solve_2sat(expr, **solve_kwargs(args)):
+            output(args, ass)
+
+
+def nsat_cdcl_cmd(args):
     for line in lines(args):
         expr = nsat.parse(line.strip())
-        for ass in nsat.solve_checksum(expr, match, args.parallel):
-            print ass
+        for ass in nsat.solve_cdcl(expr, **solve_kwargs(args)):
+            output(args, ass)
+
+
+def nsat_count_cmd(args):
+    for line in lines(args):
+        print nsat.count(nsat.parse(line.strip()), mode=args.cnf)
 
 
 def nsat_checksum_http_cmd(args):
@@ -46,12 +113,32 @@ def nsat_checksum_http_cmd(args):
         (args.host, args.port),
         path=args.path,
         timeout=args.timeout,
+        min_rto=args.min_rto,
+        max_rto=args.max_rto,
         verbose=not args.quiet,
     )
-    for line in lines(args):
-        expr = nsat.parse(line.strip())
-        for ass in nsat.solve_checksum(expr, match, args.parallel):
-            print ass
+    with executor(args) as parallel:
+        for line in lines(args):
+            expr = nsat.parse(line.strip())
+            for ass in nsat.solve_checksum(
+                    expr, match, parallel, **solve_kwargs(args)
+                    ):
+                output(args, ass)
+
+
+def nsat_dimacs_cmd(args):
+    # e.g. nsat dimacs uf20-01.cnf, models in competition output format
+    solver = getattr(nsat, 'solve_' + args.solver)
+    if args.path:
+        with open(args.path) as fp:
+            store = nsat.dimacs.load(fp)
+    else:
+        store = nsat.dimacs.load(sys.stdin)
+    solutions = solver(
+        store, simplify=args.simplify, decompose=args.decompose,
+        limit=args.models if args.models > 0 else None,
+    )
+    nsat.dimacs.dump_models(solutions, store, sys.stdout)
 
 
 def cmd_parser():
@@ -61,6 +148,48 @@ def cmd_parser():
     return parser
 
 
+def solve(args, expr, solver, **kwargs):
+    if not args.no_2sat:
+        try:
+            nsat.sat(expr, n=2, mode=args.cnf)
+        except ValueError:
+            pass
+        else:
+            return nsat.solve_2sat(expr, **solve_kwargs(args))
+    kwargs.update(solve_kwargs(args))
+    return solver(expr, **kwargs)
+
+
+def solve_kwargs(args):
+    return dict(
+        mode=args.cnf,
+        simplify=args.simplify,
+        cubes=args.cubes,
+        decompose=args.decompose,
+        limit=args.limit,
+        first=args.first,
+    )
+
+
+def output(args, ass):
+    if not args.cubes:
+        print ass
+        return
+    # e.g. a !c, vars left out are free and * is everything
+    print ' '.join(
+        name if val else '!' + name for name, val in sorted(ass.items())
+    ) or '*'
+
+
+@contextlib.contextmanager
+def executor(args):
+    if not args.parallel:
+        yield False
+        return
+    with nsat.Executor() as executor:
+        yield executor
+
+
 def lines(args):
     while True:
         line = sys.stdin.readline()
@@ -1,10 +1,23 @@
+import collections
+import errno
+import functools
+import itertools
+import pickle
+import select
+import socket
+import StringIO
+import struct
+import subprocess
+import sys
 import threading
+import types
 import wsgiref.simple_server
 
 import iptc
 import pytest
 
 import nsat
+from nsat.solver import product
 
 
 nsat_fixtures = dict([
@@ -78,7 +91,13 @@ def host(request):
     def stop():
         server.shutdown()
 
-    server = wsgiref.simple_server.make_server('127.0.0.1', 0, app)
+    class Server(wsgiref.simple_server.WSGIServer):
+        # room for every probe's handshake at once
+        request_queue_size = 1024
+
+    server = wsgiref.simple_server.make_server(
+        '127.0.0.1', 0, app, server_class=Server,
+    )
     thread = threading.Thread(target=server.serve_forever)
     thread.daemon = True
     thread.start()
@@ -131,6 +150,842 @@ def test_nsat_checksum(raw):
     assert expected == actual
 
 
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_compile(raw):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    evaluator = expr.compile()
+    assert expected == normalize(evaluator.models())
+    assert expected == normalize(evaluator.models(width=2))
+    for solution in expected:
+        assert evaluator.eval(dict(solution))
+
+
+def test_nsat_all():
+    for name in nsat.__all__:
+        assert getattr(nsat, name) is not None
+
+
+def test_nsat_import_lazy():
+    # scapy is only needed for checksums_http
+    out = subprocess.check_output([sys.executable, '-c', (
+        'import sys, nsat; nsat.parse("a and !b"); '
+        'print "scapy" in sys.modules, nsat.grammar._parser[0] is None'
+    )])
+    assert out.split() == ['False', 'True']
+
+
+def test_nsat_grammar_tables(monkeypatch):
+    from ply import yacc
+
+    grammar = sys.modules['nsat.grammar']
+    # stale tables are rebuilt, but not written back to a read-only install
+    stale = types.ModuleType('nsat.parsetab')
+    stale._tabversion = '0'
+    monkeypatch.setitem(sys.modules, 'nsat.parsetab', stale)
+    monkeypatch.setattr(grammar, '_parser', [None, None])
+    monkeypatch.setattr(grammar.os, 'access', lambda path, mode: False)
+    written = []
+    monkeypatch.setattr(
+        yacc.LRGeneratedTable, 'write_table',
+        lambda self, *args, **kwargs: written.append(args),
+    )
+    expr = nsat.parse('a and !(b or c)', mode='ply')
+    assert unicode(expr) == 'a and !(b or c)' and not written
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys() + [
+    'a and b and c or d',
+    'a && b and c & d',
+    '!(a or b) and ~!c',
+    'not (a) or ((b))',
+])
+def test_nsat_parse(raw):
+    expr = nsat.parse(raw)
+    expected = normalize(nsat.parse(raw, mode='ply').compile().models())
+    assert expected == normalize(expr.compile().models())
+    assert unicode(expr) == unicode(nsat.parse(unicode(expr)))
+
+
+def test_nsat_parse_flat():
+    expr = nsat.parse(' and '.join(
+        '(v{0} or !v{1} or v{2})'.format(i, i + 1, i + 2) for i in range(5000)
+    ))
+    assert len(expr) == 5000 and all(len(e) == 3 for e in expr)
+    assert len(nsat.parse('a or b or c and d')) == 2
+    for raw, pos in [
+            ('a and', 5), ('a ) b', 2), ('(a or (b)', 0), ('a $ b', 2),
+            ('a b', 2), ('', 0),
+            ]:
+        with pytest.raises(nsat.ParseError) as exc_info:
+            nsat.parse(raw)
+        assert exc_info.value.pos == pos
+
+
+def test_nsat_interned():
+    expr = nsat.parse('(a and b) or !(a and b)')
+    assert expr[0] is expr[1].expr
+    assert expr is nsat.parse('(a and b) or !(a and b)')
+    assert nsat.cnf(expr) is nsat.cnf(expr)
+    assert pickle.loads(pickle.dumps(expr)) is expr
+    assert pickle.loads(pickle.dumps(expr, 2)) is expr
+    for e, _ in expr.traverse():
+        assert not hasattr(e, '__dict__')
+    assert expr.vars == (nsat.var('a'), nsat.var('b'))
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_dnf(raw):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    evaluator = nsat.or_(nsat.dnf(expr, stream=True)).compile(expr.vars)
+    assert expected == normalize(evaluator.models())
+    evaluator = nsat.dnf(expr).compile(expr.vars)
+    assert expected == normalize(evaluator.models())
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_cubes(raw):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    for solve, kwargs in [
+            (nsat.solve_cdcl, {}),
+            (nsat.solve_cdcl, {'simplify': True}),
+            (nsat.solve_cdcl, {'mode': 'tseitin'}),
+            (nsat.solve_checksum, {}),
+            (nsat.solve_constraint, {'simplify': True}),
+            ]:
+        actual = list(nsat.expand(solve(expr, cubes=True, **kwargs), expr))
+        assert len(actual) == len(expected)
+        assert expected == normalize(actual)
+
+
+def test_nsat_cubes_compact():
+    expr = nsat.parse('a or (b and c and d and e and f and g and h)')
+    # disjoint cubes, 2 if a comes first or 8 if b..h does
+    cubes = list(nsat.solve_cdcl(expr, cubes=True))
+    assert len(cubes) <= 8
+    assert len(list(nsat.expand(cubes, expr))) == 2 ** 7 + 1
+    cubes = list(nsat.solve_checksum(expr, cubes=True))
+    assert len(list(nsat.expand(cubes, expr))) == 2 ** 7 + 1
+    assert len(cubes) < 2 ** 7
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_decompose(raw, executor):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    for solve, kwargs in [
+            (nsat.solve_cdcl, {}),
+            (nsat.solve_cdcl, {'cubes': True}),
+            (nsat.solve_checksum, {'parallel': executor}),
+            (nsat.solve_constraint, {'simplify': True}),
+            ]:
+        actual = list(nsat.expand(solve(expr, decompose=True, **kwargs), expr))
+        assert len(actual) == len(expected)
+        assert expected == normalize(actual)
+
+
+def test_nsat_decompose_parallel(monkeypatch):
+    # components share one pool
+    pools = []
+
+    class Executor(nsat.Executor):
+
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            super(Executor, self).__init__(2, *args[1:], **kwargs)
+
+    monkeypatch.setattr(nsat, 'Executor', Executor)
+    monkeypatch.setattr(sys.modules['nsat.solver'], 'Executor', Executor)
+    expr = nsat.parse('(a or b) and (c or !d) and (e or f)')
+    assert len(list(nsat.components(nsat.cnf(expr).collapse()))) == 3
+    actual = normalize(nsat.solve_checksum(
+        expr, decompose=True, parallel=True,
+    ))
+    assert actual == normalize(nsat.solve_cdcl(expr))
+    assert len(pools) == 1
+
+
+def test_nsat_decompose_halves():
+    # 2 * 2 ** 12 candidates rather than 2 ** 24
+    expr = nsat.parse(' and '.join(
+        '(v{0} or !v{1} or v{2})'.format(
+            h + i % 12, h + (i * 7 + 3) % 12, h + i * 5 % 11,
+        )
+        for h in (0, 12) for i in range(40)
+    ))
+    cnf_expr = nsat.cnf(expr).collapse()
+    assert [len(c.vars) for c in nsat.components(cnf_expr)] == [12, 12]
+    half = nsat.parse(' and '.join(
+        '(v{0} or !v{1} or v{2})'.format(i % 12, (i * 7 + 3) % 12, i * 5 % 11)
+        for i in range(40)
+    ))
+    count = len(list(half.compile().models()))
+    actual = list(nsat.solve_checksum(expr, decompose=True))
+    assert len(actual) == count ** 2
+    assert len(normalize(actual)) == count ** 2
+    # the product is lazy
+    solutions = product([
+        [{'a': True}, {'a': False}],
+        ({'b': i} for i in itertools.count()),
+    ])
+    assert next(solutions) == {'a': True, 'b': 0}
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_count(raw):
+    expr = nsat.parse(raw)
+    assert nsat.count(expr) == len(nsat_fixtures[raw])
+    assert nsat.count(expr, mode='tseitin') == len(nsat_fixtures[raw])
+
+
+def test_nsat_count_large():
+    expr = nsat.parse(' and '.join(
+        '(v{0} or !v{1} or v{2})'.format(i % 12, (i * 7 + 3) % 12, i * 5 % 11)
+        for i in range(30)
+    ))
+    assert nsat.count(expr) == len(list(expr.compile().models()))
+    assert nsat.count(nsat.and_(expr, nsat.parse('z or !z'))) == 2 * 199
+    expr = nsat.and_(
+        nsat.parse('x{0} or !y{0}'.format(i)) for i in range(100)
+    )
+    assert nsat.count(expr) == 3 ** 100
+    assert nsat.count(nsat.parse('a and (!a or b) and !b')) == 0
+    store = nsat.dimacs.load(['p cnf 4 2', '1 -2 0', '-1 0'])
+    assert nsat.count(store) == 4
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_limit(raw, executor):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    for solve, kwargs in [
+            (nsat.solve_checksum, {}),
+            (nsat.solve_checksum, {'parallel': executor}),
+            (nsat.solve_constraint, {}),
+            (nsat.solve_cdcl, {'decompose': True}),
+            ]:
+        actual = list(solve(expr, limit=2, **kwargs))
+        assert len(actual) == min(2, len(expected))
+        assert normalize(actual) <= expected
+        actual = list(solve(expr, first=True, **kwargs))
+        assert len(actual) == 1 and normalize(actual) <= expected
+
+
+def test_nsat_limit_executor(executor):
+    # 2 ** 20 candidates in 2 ** 18 tasks, none left running once one is
+    # found or the second job would wait on them
+    expr = nsat.and_(nsat.parse('!v{0} or !v{1}'.format(i, i + 1))
+                     for i in range(19))
+    actual = list(nsat.solve_checksum(expr, parallel=executor, first=True))
+    assert len(actual) == 1 and expr.eval(actual[0])
+    expr = nsat.parse('a or b')
+    actual = normalize(nsat.solve_checksum(expr, parallel=executor))
+    assert actual == nsat_fixtures['a or b']
+
+
+def test_nsat_dnf_stream():
+    terms = list(nsat.dnf(
+        nsat.parse('(a or b or a) and (!a or c) and (b or !b)'), stream=True,
+    ))
+    # a and b and c comes up twice, a and !a and ... never
+    assert map(unicode, terms) == [
+        'a and b and c', 'a and !b and c', '!a and b', 'b and c',
+    ]
+    # 2 ** 40 terms
+    expr = nsat.and_(
+        nsat.parse('x{0} or y{0}'.format(i)) for i in range(40)
+    )
+    terms = nsat.dnf(expr, stream=True)
+    assert [len(next(terms)) for _ in range(3)] == [40, 40, 40]
+    # repeats from different combinations, and none kept
+    terms = nsat.dnf(nsat.parse('(a or b) and (b or a)'), stream=True)
+    assert map(unicode, terms) == ['a and b', 'a', 'b']
+    # 3000 deep, alternating so nothing's flattened
+    expr = nsat.var('v0')
+    for i in range(1, 3000):
+        op = nsat.and_ if i % 2 else nsat.or_
+        expr = op(expr, nsat.var('v{0}'.format(i)))
+    terms = nsat.dnf(expr, stream=True)
+    assert len(next(terms)) == 1501
+
+
+def test_nsat_traverse_deep():
+    # the ply grammar builds a 3000 deep chain of binary ands
+    expr = nsat.parse(' and '.join(
+        '(v{0} or !v{1})'.format(i, i + 1) for i in range(3000)
+    ), mode='ply')
+    assert len(list(expr.traverse())) > 3000 * 3
+    assert expr.vars == tuple(nsat.var('v{0}'.format(i)) for i in range(3001))
+    assert expr.vars is expr.vars
+    assert len(nsat.cnf(expr)) == 3000
+    expr = nsat.parse('!(a or b) and c')
+    assert [e for e, _ in expr.traverse(depth=2)] == [expr, expr[0], expr[1]]
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_constraint_tseitin(raw):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    actual = list(nsat.solve_constraint(expr, mode='tseitin'))
+    assert len(actual) == len(expected)
+    assert expected == normalize(actual)
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_checksum_unvectorized(raw):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    match = lambda case: nsat.checksums(case)
+    actual = normalize(nsat.solve_checksum(expr, match))
+    assert expected == actual
+
+
+def test_nsat_matcher_fold():
+    assert nsat.matcher.fold(0x1fffe) == 0
+    assert nsat.matcher.fold(0x12345 + 0xffff) == nsat.matcher.fold(0x12345)
+    assert nsat.matcher.table(2, 1) == frozenset([0b01, 0b10])
+    assert len(nsat.matcher.table(3, 7)) == 3 ** 7
+    assert 0 not in nsat.matcher.table(3, 7)
+
+
+def test_nsat_packing_gray():
+    expr = nsat.parse('(a or b) and (!b or c or !d) and (d or !e)')
+    packing = nsat.packing.Packing(nsat.sat(expr))
+    seen = set()
+    for lo, hi in packing.ranges(5):
+        prev = None
+        for candidate, data, totals in packing.expand(lo, hi):
+            assert data == packing.data(candidate)
+            assert totals == packing.totals(data)
+            if prev is not None:
+                assert bin(prev ^ candidate).count('1') == 1
+            prev = candidate
+            seen.add(candidate)
+    assert seen == set(range(packing.size))
+
+
+def test_nsat_checksum_groups(executor):
+    expr = nsat.parse(' and '.join(
+        '(v{0} or !v{1} or v{2})'.format(i % 12, (i * 7 + 3) % 12, i * 5 % 11)
+        for i in range(20)
+    ))
+    assert nsat.packing.Packing(nsat.sat(expr)).groups == 3
+    expected = normalize(expr.compile().models())
+    assert expected == normalize(nsat.solve_checksum(expr))
+    assert expected == normalize(nsat.solve_checksum(
+        expr, lambda case: nsat.checksums(case),
+    ))
+    assert expected == normalize(nsat.solve_checksum(
+        expr, parallel=executor,
+    ))
+
+
+@pytest.fixture(scope='module')
+def executor(request):
+    executor = nsat.Executor(processes=2, chunksize=4)
+    request.addfinalizer(executor.close)
+    return executor
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_checksum_executor(raw, executor):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    actual = normalize(nsat.solve_checksum(expr, parallel=executor))
+    assert expected == actual
+
+
+def test_nsat_checksum_parallel():
+    raw = '(a or b) and (!b or c or !d) and (d or !e)'
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    actual = normalize(nsat.solve_checksum(expr, parallel=True))
+    assert expected == actual
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_checksum_tseitin(raw):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    actual = normalize(
+        nsat.solve_checksum(expr, nsat.checksums, mode='tseitin')
+    )
+    assert expected == actual
+
+
+def test_nsat_cnf_tseitin_linear():
+    expr = nsat.parse(' or '.join(
+        '(a{0} and b{0})'.format(i) for i in range(32)
+    ))
+    cnf_expr = nsat.cnf(expr, mode='tseitin')
+    assert len(cnf_expr) == 3 * 32 + 3 * 29 + 1
+    assert max(len(clause) for clause in cnf_expr) == 3
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_cdcl(raw):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    actual = list(nsat.solve_cdcl(expr))
+    assert len(actual) == len(expected)
+    assert expected == normalize(actual)
+    assert expected == normalize(nsat.solve_cdcl(expr, mode='tseitin'))
+
+
+def test_nsat_cdcl_pigeonhole():
+    # 4 pigeons, 3 holes
+    ps, hs = range(4), range(3)
+    expr = nsat.parse(' and '.join(
+        ['({0})'.format(' or '.join('p{0}h{1}'.format(p, h) for h in hs))
+         for p in ps] +
+        ['(!p{0}h{2} or !p{1}h{2})'.format(p, q, h)
+         for h in hs for p in ps for q in ps if p < q]
+    ))
+    assert list(nsat.solve_cdcl(expr)) == []
+
+
+def test_nsat_cdcl_random():
+    expr = nsat.parse(' and '.join(
+        '(v{0} or !v{1} or v{2})'.format(i % 12, (i * 7 + 3) % 12, i * 5 % 11)
+        for i in range(30)
+    ))
+    expected = normalize(expr.compile().models())
+    actual = list(nsat.solve_cdcl(expr))
+    assert len(actual) == len(expected)
+    assert expected == normalize(actual)
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_nsat_simplify(raw):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    assert expected == normalize(nsat.solve_cdcl(expr, simplify=True))
+    assert expected == normalize(nsat.solve_checksum(expr, simplify=True))
+
+
+def test_nsat_simplify_steps():
+    # unit a, then pure !d, b and c left free, (e or !e) dropped
+    expr = nsat.parse(
+        'a and (!a or b or c) and (!d or b) and (!d or c) and (e or !e)'
+    )
+    simplified = nsat.simplify(nsat.cnf(expr))
+    assert not simplified.unsat
+    assert simplified.expr is None
+    expected = normalize(expr.compile().models())
+    actual = list(nsat.solve_cdcl(expr, simplify=True))
+    assert len(actual) == len(expected)
+    assert expected == normalize(actual)
+    assert list(nsat.solve_2sat(
+        nsat.parse('a and !a and (b or c)'), simplify=True,
+    )) == []
+
+
+@pytest.mark.parametrize('raw', [
+    '!a and (b or c)',
+    'a or b',
+    'a and b',
+    '!(b or c)',
+    '(a and b) or c',
+    'a and (b or (d and e))',
+])
+def test_nsat_2sat(raw):
+    expr = nsat.parse(raw)
+    expected = nsat_fixtures[raw]
+    actual = normalize(nsat.solve_2sat(expr))
+    assert expected == actual
+
+
+def test_nsat_2sat_unsat():
+    expr = nsat.parse('(a or b) and (!a or b) and (a or !b) and (!a or !b)')
+    assert list(nsat.solve_2sat(expr)) == []
+
+
+def test_nsat_2sat_chain():
+    names = ['v{0}'.format(i) for i in range(40)]
+    expr = nsat.parse(' and '.join(
+        '(!{0} or {1})'.format(a, b) for a, b in zip(names, names[1:])
+    ))
+    assert len(list(nsat.solve_2sat(expr))) == len(names) + 1
+
+
+def test_nsat_dimacs():
+    data = StringIO.StringIO()
+    store = nsat.dimacs.dump(nsat.parse('(a or !b) and (b or c) and !a'), data)
+    assert data.getvalue().splitlines()[3:] == [
+        'p cnf 3 3', '1 -2 0', '2 3 0', '-1 0',
+    ]
+    loaded = nsat.dimacs.load(data.getvalue().splitlines())
+    assert list(loaded) == list(store)
+    assert loaded.names == ['x1', 'x2', 'x3']
+    assert loaded.lits.typecode == 'i'
+
+    lines = [
+        'c satlib style, clauses span lines',
+        'p cnf 4 3',
+        ' 1 -2',
+        ' 3 0 -1 2 0',
+        '-3 -4 0',
+        '%',
+        '0',
+    ]
+    store = nsat.dimacs.load(lines)
+    assert len(store) == 3
+    assert list(store[1]) == [1, 2]
+    expected = normalize(store.expr.compile().models())
+    for solve in (nsat.solve_cdcl, nsat.solve_checksum, nsat.solve_constraint):
+        actual = list(solve(store))
+        assert len(actual) == len(expected)
+        assert expected == normalize(actual)
+        assert expected == normalize(solve(store, simplify=True))
+    # x4 only w/ x3, x2 free once x1 is false
+    assert len(list(nsat.solve_2sat(nsat.dimacs.load([
+        'p cnf 4 2', '1 -2 0', '-1 0',
+    ])))) == 4
+
+    out = StringIO.StringIO()
+    count = nsat.dimacs.dump_models(nsat.solve_cdcl(store), store, out)
+    assert count == len(expected)
+    assert out.getvalue().startswith('s SATISFIABLE\nv ')
+    with pytest.raises(ValueError):
+        nsat.dimacs.load(['p cnf 2 1', '1 3 0'])
+
+
+def test_spoof_segment():
+    from nsat import spoof
+    from scapy import all as scapy
+
+    def checksums(pkt):
+        ip = scapy.IP(bytes(pkt))
+        return ip.chksum, ip[scapy.TCP].chksum, ip
+
+    def expected(pkt):
+        _, _, ip = checksums(pkt)
+        del ip.chksum
+        del ip[scapy.TCP].chksum
+        return checksums(scapy.IP(str(ip)))[:2]
+
+    segment = spoof.Segment('10.0.0.1', '10.0.0.2', 40000, 8080)
+    assert checksums(segment.packet())[:2] == expected(segment.packet())
+    for seq, ack, flags, payload in [
+            (0xfffffff0, 0, 'S', b''),
+            (0xfffffff1, 0x12345678, 'A', b''),
+            (0xfffffff1, 0, 'P', b'GET / HTTP/1.0\r\n\r\n'),
+            (0x00000010, 0, 'PA', b'odd'),
+            (0x00000010, 1, 'F', b''),
+            ]:
+        pkt = segment.set(seq, ack, flags, payload).packet()
+        _, _, ip = checksums(pkt)
+        assert ip[scapy.TCP].seq == seq and ip[scapy.TCP].ack == ack
+        assert str(ip[scapy.TCP].payload) == payload
+        assert checksums(pkt)[:2] == expected(pkt)
+
+    # a word patched into a payload at an even or odd offset
+    for path in ['/', '/a']:
+        data = struct.pack('!HH', 0, 0)
+        zeros = spoof.http_get_payload(path, data=data)
+        word = 0x1234 if path == '/' else 0x3412
+        c = spoof.update(segment.set(payload=zeros).checksum, 0, word)
+        pkt = segment.set(
+            payload=spoof.http_get_payload(path, data=struct.pack(
+                '!HH', 0x1234, 0,
+            )),
+        ).packet()
+        assert c == expected(pkt)[1]
+
+
+def test_spoof_rto():
+    from nsat import spoof
+
+    rto = spoof.RTO(1.0, lo=0.01)
+    assert rto.value == 1.0
+    rto.sample(0.1)
+    assert (rto.srtt, rto.rttvar) == (0.1, 0.05)
+    assert abs(rto.value - 0.3) < 1e-9
+    assert rto.initial == 1.0
+    for _ in xrange(100):
+        rto.sample(0.0001)
+    assert rto.value == 0.01
+    # never past hi, which is initial by default
+    for _ in xrange(100):
+        rto.sample(5.0)
+    assert rto.value == 1.0
+    assert spoof.RTO(1.0, hi=10.0).value == 1.0
+
+
+def test_spoof_raw_socket():
+    from nsat import spoof
+
+    sock = spoof.RawSocket('127.0.0.1', 40001, 40002)
+    try:
+        for sport, dport, seq in [
+                (40001, 40003, 1),
+                (40004, 40002, 2),
+                (40001, 40002, 3),
+                ]:
+            sock.send(spoof.Segment(
+                '127.0.0.1', '127.0.0.1', sport, dport,
+            ).set(seq, 0, 'PA', b'abc').packet())
+        assert select.select([sock], [], [], 1.0)[0]
+        assert sock.recv() == (40002, 3, 0, 0x18, b'abc')
+        assert sock.recv() is None
+    finally:
+        sock.close()
+
+
+class FakeRTO(object):
+
+    initial = value = 0.05
+
+    def __init__(self):
+        self.samples = []
+
+    def sample(self, rtt):
+        self.samples.append(rtt)
+
+
+def drive(task, replies):
+    # runs a probes task, answering each wait w/ the next of replies, an
+    # (flags, acked) or None for a timeout. gives the flags sent.
+    sent = []
+    replies = collections.deque(replies)
+    reply = None
+    while True:
+        try:
+            packet, ack, _ = task.send(reply)
+        except StopIteration:
+            return sent
+        sent.append(packet[33])
+        reply = None
+        if ack is not None:
+            r = replies.popleft()
+            if r is not None:
+                flags, acked = r
+                reply = (1000, ack if acked else 0, flags, b'')
+
+
+@pytest.mark.parametrize('replies,acked,sent', [
+    ([('SA', True), ('A', True)], [True], ['S', 'A', 'PA', 'FA']),
+    ([('SA', True), None, None], [False, False], [
+        'S', 'A', 'PA', 'PA', 'FA',
+    ]),
+    # an ack after a timeout may be a late one, so neither's done
+    ([('SA', True), None, ('A', True)], [], ['S', 'A', 'PA', 'PA', 'FA']),
+    # no handshake
+    ([None], [], ['S']),
+    # the peer closes w/ a probe in flight
+    ([('SA', True), ('FA', False)], [], ['S', 'A', 'PA', 'FA']),
+    ([('SA', True), ('R', False)], [], ['S', 'A', 'PA']),
+])
+def test_spoof_probes(replies, acked, sent):
+    from nsat import spoof
+
+    def flags(s):
+        return sum(spoof.FLAGS[f] for f in s)
+
+    done = []
+    jobs = collections.deque(
+        (b'job', None, functools.partial(lambda i, a: done.append((i, a)), i))
+        for i in xrange(2)
+    )
+    segment = spoof.Segment('10.0.0.1', '10.0.0.2', 40000, 8080)
+    task = spoof.probes(
+        segment, lambda: jobs.popleft() if jobs else None,
+        lambda job, timed_out=False: jobs.appendleft(job), FakeRTO(),
+    )
+    assert drive(task, [
+        r and (flags(r[0]), r[1]) for r in replies
+    ]) == [flags(f) for f in sent]
+    # only what the peer answered is resolved, the rest is put back
+    assert done == list(enumerate(acked))
+    assert len(jobs) == 2 - len(acked)
+
+
+def test_spoof_probes_refused():
+    from nsat import spoof
+
+    jobs = collections.deque([(b'job', None, None)])
+    task = spoof.probes(
+        spoof.Segment('10.0.0.1', '10.0.0.2', 40000, 8080),
+        jobs.popleft, jobs.appendleft, FakeRTO(),
+    )
+    with pytest.raises(socket.error) as e:
+        drive(task, [(spoof.FLAGS['R'] | spoof.FLAGS['A'], True)])
+    assert e.value.errno == errno.ECONNREFUSED
+    assert len(jobs) == 1
+
+
+def test_spoof_probes_syn_backoff():
+    from nsat import spoof
+
+    # a syn waits from rto's initial value on, whatever's been sampled
+    rto = FakeRTO()
+    rto.value = 0.01
+    jobs = collections.deque([(b'job', None, None)])
+    put = []
+    task = spoof.probes(
+        spoof.Segment('10.0.0.1', '10.0.0.2', 40000, 8080),
+        jobs.popleft, lambda *args: put.append(args), rto, retry=2,
+    )
+    timeouts = [next(task)[2]] + [task.send(None)[2] for _ in xrange(2)]
+    assert timeouts == [0.05, 0.1, 0.2]
+    with pytest.raises(StopIteration):
+        task.send(None)
+    # back as timed out
+    assert put == [((b'job', None, None), True)]
+
+
+class FakePeer(object):
+
+    # stands in for spoof.RawSocket, a host that completes handshakes, acks
+    # payloads only w/ a valid tcp checksum and closes on a fin. the first
+    # fins payloads are answered w/ a fin instead, the acks of the first
+    # late valid ones are held until the next segment on their connection,
+    # and a mute one answers nothing at all.
+    peers = []
+    fins = 0
+    late = 0
+    mute = False
+
+    def __init__(self, host, port, sport=None):
+        self.addr = socket.inet_aton(host)
+        self.r, self.w = socket.socketpair()
+        self.replies = collections.deque()
+        self.sent = []
+        self.held = {}
+        self.peers.append(self)
+
+    def fileno(self):
+        return self.r.fileno()
+
+    def send(self, packet):
+        from nsat import spoof
+
+        packet = bytes(packet)
+        sport, _, seq, _, flags = struct.unpack_from(b'!HHIIH', packet, 20)
+        tcp = packet[20:]
+        payload = tcp[(flags >> 12) * 4:]
+        flags &= 0x3f
+        self.sent.append((sport, flags, payload))
+        if self.mute:
+            return
+        if sport in self.held:
+            self.replies.append(self.held.pop(sport))
+            self.w.send(b'x')
+        if flags & spoof.FLAGS['S']:
+            self._reply(sport, 1000, seq + 1, 'SA')
+        elif flags & spoof.FLAGS['F']:
+            self._reply(sport, 1001, seq + len(payload) + 1, 'FA')
+        elif payload and self.fins:
+            self.fins -= 1
+            self._reply(sport, 1001, seq, 'FA')
+        elif payload and spoof.checksum_sum(
+                packet[12:20] + struct.pack(b'!HH', 6, len(tcp)) + tcp,
+                ) == 0xffff:
+            if self.late:
+                self.late -= 1
+                self.held[sport] = self._segment(
+                    sport, 1001, seq + len(payload), 'A',
+                )
+            else:
+                self._reply(sport, 1001, seq + len(payload), 'A')
+
+    def _segment(self, dport, seq, ack, flags):
+        from nsat import spoof
+
+        return (
+            dport, seq, ack & 0xffffffff,
+            sum(spoof.FLAGS[f] for f in flags), b'',
+        )
+
+    def _reply(self, *args):
+        self.replies.append(self._segment(*args))
+        self.w.send(b'x')
+
+    def recv(self):
+        if not self.replies:
+            return None
+        self.r.recv(1)
+        return self.replies.popleft()
+
+    def close(self):
+        self.r.close()
+        self.w.close()
+
+
+@pytest.fixture
+def peer(monkeypatch):
+    from nsat import spoof
+
+    del FakePeer.peers[:]
+    monkeypatch.setattr(spoof, 'RawSocket', FakePeer)
+    return FakePeer.peers
+
+
+@pytest.mark.parametrize('raw', nsat_fixtures.keys())
+def test_spoof_engine(raw, peer):
+    expr = nsat.parse(raw)
+    match = nsat.checksums_http(('127.0.0.1', 8080), verbose=0, timeout=0.05)
+    actual = normalize(nsat.solve_checksum(expr, match))
+    assert nsat_fixtures[raw] == actual
+    assert all(not p.replies for p in peer)
+
+
+def test_spoof_engine_shared(peer, monkeypatch):
+    raw = '(a or b) and (!b or c or !d) and (d or !e)'
+    monkeypatch.setattr(FakePeer, 'fins', 3)
+    match = nsat.checksums_http(
+        ('127.0.0.1', 8080), verbose=0, timeout=0.05, limit=2,
+    )
+    actual = normalize(nsat.solve_checksum(nsat.parse(raw), match))
+    # probes the peer closed on are sent again
+    assert nsat_fixtures[raw] == actual
+    assert peer[0].fins == 0
+    # and connections answer many
+    flags = [f for _, f, _ in peer[0].sent]
+    assert flags.count(0x02) < flags.count(0x18)
+
+
+def test_spoof_engine_late(peer, monkeypatch):
+    monkeypatch.setattr(FakePeer, 'late', 1)
+    match = nsat.checksums_http(
+        ('127.0.0.1', 8080), verbose=0, timeout=0.05, limit=1,
+    )
+    # the first's match is its last probe, so its ack comes late during
+    # the second's first, on the same connection
+    results = list(match.imap([
+        ([5], [set([1, 5])]),
+        ([7], [set([1, 2])]),
+    ]))
+    assert results == [([5], True), ([7], False)]
+    assert peer[0].late == 0
+
+
+def test_spoof_engine_mute(peer, monkeypatch):
+    monkeypatch.setattr(FakePeer, 'mute', True)
+    match = nsat.checksums_http(
+        ('127.0.0.1', 8080), verbose=0, timeout=0.05, retry=1,
+    )
+    # gives up once a job's handshakes time out retry times over
+    with pytest.raises(socket.timeout):
+        list(match.imap([([0x100], [set(xrange(8))])] * 4))
+    flags = [f for _, f, _ in peer[0].sent]
+    assert len(flags) == flags.count(0x02) <= 4 * 8 * 2 * 2
+
+
+def test_spoof_engine_close(peer):
+    match = nsat.checksums_http(
+        ('127.0.0.1', 8080), verbose=0, timeout=0.05, limit=2,
+    )
+    # none match, so each takes every probe
+    results = match.imap([([0x100], [set(xrange(8))])] * 50)
+    assert next(results) == ([0x100], False)
+    sent = sum(bool(p) for _, _, p in peer[0].sent)
+    results.close()
+    assert sum(bool(p) for _, _, p in peer[0].sent) == sent
+
+
 @pytest.mark.parametrize('raw', [
     'a or b',
     'a and b',